@@ -161,6 +161,10 @@ decman.config.pkg_cache_dir = "/var/cache/decman"
 # Timeout in seconds for fetching aur package details.
 decman.config.aur_rpc_timeout = 30
 
+# Number of seconds fetched aur package details are reused between decman runs.
+# Reused details may miss new releases, so by default (None) they are always fetched again.
+decman.config.aur_rpc_cache_ttl = None
+
 # Enable installing and upgrading foreign packages.
 decman.config.enable_fpm = True
 
@@ -180,6 +184,9 @@ class MyCommands(decman.config.Commands):
     def list_foreign_pkgs_versioned(self) -> list[str]:
         return ["pacman", "-Qm", "--color=never"]
 
+    def list_repo_pkgs(self) -> list[str]:
+        return ["pacman", "-Slq"]
+
     # --color=always is used in many commands since --color=auto results in no color.
     # It seems a sensible default for me, since decman already uses color and it can't be disabled.
 
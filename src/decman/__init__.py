@@ -2,6 +2,11 @@
 Module for writing system configurations for decman.
 """
 
+import fcntl
+import functools
+import re
+import shlex
+import signal
 import typing
 import pwd
 import grp
@@ -10,6 +15,12 @@ import os
 import subprocess
 import decman.error
 
+# ioctl request for sharing the data blocks of a file (reflink) on supporting filesystems.
+_FICLONE = 0x40049409
+_COPY_BLOCKSIZE = 8 * 1024 * 1024
+_TEMPLATE_CHUNK_SIZE = 64 * 1024
+_MAX_PARALLEL_FILE_COPIES = 8
+
 
 class UserRaisedError(Exception):
     """
@@ -20,75 +31,235 @@ class UserRaisedError(Exception):
         super().__init__(message)
 
 
-def sh(sh_cmd: str,
-       user: typing.Optional[str] = None,
-       env_overrides: typing.Optional[dict[str, str]] = None):
+@functools.lru_cache(maxsize=None)
+def _user_ids(user: typing.Union[str, int]) -> tuple[int, int]:
     """
-    Shortcut for running a shell command.
+    Returns the uid and the primary gid of the user given as a name or a uid. Raises KeyError if
+    the user doesn't exist.
     """
-    if env_overrides is None:
-        env_overrides = {}
+    if isinstance(user, int):
+        entry = pwd.getpwuid(user)
+    else:
+        entry = pwd.getpwnam(user)
+    return entry.pw_uid, entry.pw_gid
+
 
-    env = os.environ.copy()
-    for var, val in env_overrides.items():
-        env[var] = val
+@functools.lru_cache(maxsize=None)
+def _group_id(group: str) -> int:
+    """
+    Returns the gid of the group. Raises KeyError if the group doesn't exist.
+    """
+    return grp.getgrnam(group).gr_gid
+
+
+def _spawn_and_wait(command: list[str],
+                    env: typing.Optional[dict[str, str]]) -> int:
+    """
+    Runs the command and returns its exit code.
+
+    posix_spawn doesn't have to duplicate the memory mappings of this process like fork does.
+    """
+    # Python ignores these signals, so restore their defaults in the child like subprocess does.
+    pid = os.posix_spawnp(command[0],
+                          command,
+                          os.environ if env is None else env,
+                          setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    try:
+        _, status = os.waitpid(pid, 0)
+    except BaseException:
+        # Don't leave the child running or unreaped when interrupted.
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+    return os.waitstatus_to_exitcode(status)
+
+
+def _run_user_command(command: list[str], kind: str,
+                      shown: typing.Optional[str],
+                      user: typing.Optional[typing.Union[str, int]],
+                      env_overrides: typing.Optional[dict[str, str]]):
+    """
+    Runs a command for sh and prg. kind and shown describe the command in error messages.
+
+    If shown is None, the command is quoted with shlex only when an error message needs it.
+    """
+    # Without overrides the child simply inherits the environment, so there is nothing to copy.
+    env = None
+    if env_overrides:
+        env = {**os.environ, **env_overrides}
 
     if user is None:
-        try:
-            subprocess.run(sh_cmd, shell=True, check=True, env=env)
-        except subprocess.CalledProcessError as e:
+        if _spawn_and_wait(command, env) != 0:
             raise decman.error.UserFacingError(
-                f"Running user defined shell command '{sh_cmd}' failed."
-            ) from e
-    else:
-        try:
-            uid = pwd.getpwnam(user).pw_uid
-            gid = pwd.getpwnam(user).pw_gid
-        except KeyError as e:
+                f"Running user defined {kind} '{shown or shlex.join(command)}' failed."
+            )
+        return
+
+    try:
+        uid, gid = _user_ids(user)
+    except KeyError as e:
+        raise decman.error.UserFacingError(
+            f"Running user defined {kind} failed because the user {user} doesn't exist."
+        ) from e
+
+    with subprocess.Popen(command, group=gid, user=uid, env=env) as process:
+        if process.wait() != 0:
             raise decman.error.UserFacingError(
-                f"Running user defined shell command failed because the user {user} doesn't exist."
-            ) from e
+                f"Running user {kind} '{shown or shlex.join(command)}' as {user} failed."
+            )
+
+
+def sh(sh_cmd: str,
+       user: typing.Optional[typing.Union[str, int]] = None,
+       env_overrides: typing.Optional[dict[str, str]] = None):
+    """
+    Shortcut for running a shell command.
 
-        with subprocess.Popen(sh_cmd, shell=True, group=gid, user=uid,
-                              env=env) as process:
-            if process.wait() != 0:
-                raise decman.error.UserFacingError(
-                    f"Running user shell command '{sh_cmd}' as {user} failed.")
+    The user can be given as a name or a uid.
+    """
+    _run_user_command(["/bin/sh", "-c", sh_cmd], "shell command", sh_cmd, user,
+                      env_overrides)
 
 
 def prg(command: list[str],
-        user: typing.Optional[str] = None,
+        user: typing.Optional[typing.Union[str, int]] = None,
         env_overrides: typing.Optional[dict[str, str]] = None):
     """
     Shortcut for running a program.
+
+    The user can be given as a name or a uid.
     """
-    if env_overrides is None:
-        env_overrides = {}
+    _run_user_command(command, "program", None, user, env_overrides)
 
-    env = os.environ.copy()
-    for var, val in env_overrides.items():
-        env[var] = val
 
-    if user is None:
-        try:
-            subprocess.run(command, check=True, env=env)
-        except subprocess.CalledProcessError as e:
-            raise decman.error.UserFacingError(
-                f"Running user defined program '{command}' failed.") from e
-    else:
+def _walk_files(directory: str) -> typing.Iterator[str]:
+    """
+    Yields the paths of all files in the directory and its subdirectories.
+
+    Like os.walk, symlinks to directories are not followed.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                yield entry.path
+            elif not entry.is_symlink():
+                yield from _walk_files(entry.path)
+
+
+def _create_missing_dirs(dirct: str, uid: typing.Optional[int],
+                         gid: typing.Optional[int]):
+    """
+    Creates the directory and its missing parents. Created directories are owned by uid and gid.
+    """
+    if not os.path.isdir(dirct):
+        parent_dir = os.path.dirname(dirct)
+        if not os.path.isdir(parent_dir):
+            _create_missing_dirs(parent_dir, uid, gid)
+        os.mkdir(dirct)
+
+        if uid is not None:
+            assert gid is not None, "If uid is set, then gid is set."
+            os.chown(dirct, uid, gid)
+
+
+@functools.lru_cache(maxsize=None)
+def _variables_pattern(variables: tuple[str, ...]) -> re.Pattern[str]:
+    # Longer variables first, so that a variable is preferred over its prefix.
+    return re.compile("|".join(
+        map(re.escape, sorted(variables, key=len, reverse=True))))
+
+
+def _substitute_variables(content: str, variables: dict[str, str]) -> str:
+    """
+    Replaces all variables in content with their values in a single pass.
+    """
+    if len(variables) == 0:
+        return content
+
+    pattern = _variables_pattern(tuple(variables))
+    return pattern.sub(lambda match: variables[match.group(0)], content)
+
+
+def _stream_substituted(src: typing.TextIO, dst: typing.TextIO,
+                        variables: dict[str, str]):
+    """
+    Writes the contents of src to dst in chunks while replacing variables.
+    """
+    pattern = _variables_pattern(tuple(variables))
+    # A variable may be split between two chunks, so this many characters are carried over.
+    carry = max(map(len, variables)) - 1
+    tail = ""
+    while True:
+        chunk = src.read(_TEMPLATE_CHUNK_SIZE)
+        buffer = tail + chunk
+        if not chunk:
+            dst.write(_substitute_variables(buffer, variables))
+            return
+
+        # Matches starting before safe_end are complete, since every variable fits after them.
+        safe_end = len(buffer) - carry
+        written = 0
+        for match in pattern.finditer(buffer):
+            if match.start() >= safe_end:
+                break
+            dst.write(buffer[written:match.start()])
+            dst.write(variables[match.group(0)])
+            written = match.end()
+
+        split = max(written, safe_end)
+        dst.write(buffer[written:split])
+        tail = buffer[split:]
+
+
+def _copy_file_contents(source_file: str, target: str):
+    """
+    Copies the contents of source_file to target. The data is reflinked or copied inside the
+    kernel if the filesystems support it.
+    """
+    with open(source_file, "rb") as src, open(target, "wb") as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
         try:
-            uid = pwd.getpwnam(user).pw_uid
-            gid = pwd.getpwnam(user).pw_gid
-        except KeyError as e:
-            raise decman.error.UserFacingError(
-                f"Running user defined program failed because the user {user} doesn't exist."
-            ) from e
+            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src_fd, dst_fd, _COPY_BLOCKSIZE) > 0:
+                    pass
+                return
+            except OSError:
+                pass
+
+    shutil.copyfile(source_file, target)
+
+
+def _write_source_file(source_file: str, target: str, variables: dict[str,
+                                                                      str],
+                       bin_file: bool, encoding: str):
+    """
+    Writes the contents of source_file to target. Variables are replaced in text files.
+    """
+    if bin_file or len(variables) == 0:
+        _copy_file_contents(source_file, target)
+        return
+
+    with open(source_file, "rt", encoding=encoding) as src:
+        with open(target, "wt", encoding=encoding) as dst:
+            _stream_substituted(src, dst, variables)
+
+
+def _set_owner_and_permissions(target: str, uid: typing.Optional[int],
+                               gid: typing.Optional[int], permissions: int):
+    """
+    Sets the owner and permissions of the target file.
+    """
+    if uid is not None:
+        assert gid is not None, "If uid is set, then gid is set."
+        os.chown(target, uid, gid)
 
-        with subprocess.Popen(command, group=gid, user=uid,
-                              env=env) as process:
-            if process.wait() != 0:
-                raise decman.error.UserFacingError(
-                    f"Running user program '{command}' as {user} failed.")
+    os.chmod(target, permissions)
 
 
 class File:
@@ -121,11 +292,15 @@ class File:
         self.gid = None
 
         if owner is not None:
-            self.uid = pwd.getpwnam(owner).pw_uid
-            self.gid = pwd.getpwnam(owner).pw_gid
+            self.uid, self.gid = _user_ids(owner)
 
         if group is not None:
-            self.gid = grp.getgrnam(group).gr_gid
+            self.gid = _group_id(group)
+
+        # Binary content is written as is, so it can be encoded once for all targets.
+        self._encoded_content: typing.Optional[bytes] = None
+        if bin_file and content is not None:
+            self._encoded_content = content.encode(encoding=encoding)
 
     def copy_to(self,
                 target: str,
@@ -136,51 +311,22 @@ class File:
         if variables is None:
             variables = {}
 
-        target_directory = os.path.dirname(target)
-
-        def create_missing_dirs(dirct: str, uid: typing.Optional[int],
-                                gid: typing.Optional[int]):
-            if not os.path.isdir(dirct):
-                parent_dir = os.path.dirname(dirct)
-                if not os.path.isdir(parent_dir):
-                    create_missing_dirs(parent_dir, uid, gid)
-                os.mkdir(dirct)
-
-                if uid is not None:
-                    assert gid is not None, "If uid is set, then gid is set."
-                    os.chown(dirct, uid, gid)
-
-        create_missing_dirs(target_directory, self.uid, self.gid)
-
+        _create_missing_dirs(os.path.dirname(target), self.uid, self.gid)
         self._write_content(target, variables)
-
-        if self.uid is not None:
-            assert self.gid is not None, "If uid is set, then gid is set."
-            os.chown(target, self.uid, self.gid)
-
-        os.chmod(target, self.permissions)
+        _set_owner_and_permissions(target, self.uid, self.gid,
+                                   self.permissions)
 
     def _write_content(self, target: str, variables: dict[str, str]):
-        if self.source_file is not None and (self.bin_file
-                                             or len(variables) == 0):
-            shutil.copy(self.source_file, target)
-        elif self.bin_file and self.content is not None:
+        if self.source_file is not None:
+            _write_source_file(self.source_file, target, variables,
+                               self.bin_file, self.encoding)
+        elif self.bin_file:
+            assert self._encoded_content is not None, "Content should be set since source_file was not set."
             with open(target, "wb") as file:
-                file.write(self.content.encode(encoding=self.encoding))
-        elif self.source_file is not None:
-            with open(self.source_file, "rt", encoding=self.encoding) as src:
-                content = src.read()
-
-            for var, value in variables.items():
-                content = content.replace(var, value)
-
-            with open(target, "wt", encoding=self.encoding) as file:
-                file.write(content)
+                file.write(self._encoded_content)
         else:
             assert self.content is not None, "Content should be set since source_file was not set."
-            content = self.content
-            for var, value in variables.items():
-                content = content.replace(var, value)
+            content = _substitute_variables(self.content, variables)
 
             with open(target, "wt", encoding=self.encoding) as file:
                 file.write(content)
@@ -211,11 +357,10 @@ class Directory:
         self.gid = None
 
         if owner is not None:
-            self.uid = pwd.getpwnam(owner).pw_uid
-            self.gid = pwd.getpwnam(owner).pw_gid
+            self.uid, self.gid = _user_ids(owner)
 
         if group is not None:
-            self.gid = grp.getgrnam(group).gr_gid
+            self.gid = _group_id(group)
 
     def copy_to(self,
                 target_directory: str,
@@ -226,66 +371,92 @@ class Directory:
 
         Returns all created files.
         """
+        if variables is None:
+            variables = {}
+
+        if only_print:
+            return [
+                self._target_path(src_path, target_directory)
+                for src_path in _walk_files(self.source_directory)
+            ]
+
+        # Imported here, since it is slow to import and only needed when copying directories.
+        import concurrent.futures
+
         created = []
-        original_wd = os.getcwd()
-        try:
-            os.chdir(self.source_directory)
-            for src_dir, _, src_files in os.walk("."):
-                for src_file in src_files:
-                    src_path = os.path.join(src_dir, src_file)
-                    file = File(source_file=src_path,
-                                bin_file=self.bin_files,
-                                encoding=self.encoding,
-                                owner=self.owner,
-                                group=self.group,
-                                permissions=self.permissions)
-                    target = os.path.normpath(
-                        os.path.join(target_directory, src_path))
-                    created.append(target)
-
-                    if not only_print:
-                        file.copy_to(target, variables)
-        finally:
-            os.chdir(original_wd)
+        # Files in the same directory share a parent, so it only needs to be ensured once.
+        ensured_dirs = set()
+        # Copying is bound by I/O, so files are copied in parallel. Directories are still
+        # created here before the files inside them are submitted.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=_MAX_PARALLEL_FILE_COPIES) as executor:
+            copies = []
+            for src_path in _walk_files(self.source_directory):
+                target = self._target_path(src_path, target_directory)
+                created.append(target)
+
+                target_dir = os.path.dirname(target)
+                if target_dir not in ensured_dirs:
+                    _create_missing_dirs(target_dir, self.uid, self.gid)
+                    ensured_dirs.add(target_dir)
+
+                copies.append(
+                    executor.submit(self._copy_file, src_path, target,
+                                    variables))
+
+            for copy in copies:
+                copy.result()
         return created
 
+    def _target_path(self, src_path: str, target_directory: str) -> str:
+        return os.path.normpath(
+            os.path.join(target_directory,
+                         os.path.relpath(src_path, self.source_directory)))
+
+    def _copy_file(self, src_path: str, target: str, variables: dict[str,
+                                                                     str]):
+        # Files are written directly with the settings of this directory instead of creating
+        # a File for each of them.
+        _write_source_file(src_path, target, variables, self.bin_files,
+                           self.encoding)
+        _set_owner_and_permissions(target, self.uid, self.gid,
+                                   self.permissions)
+
 
 class UserPackage:
     """
     Defines a custom package.
     """
 
+    __slots__ = ("pkgname", "pkgbase", "version", "provides", "dependencies",
+                 "make_dependencies", "check_dependencies", "git_url")
+
     def __init__(
         self,
         pkgname: str,
         version: str,
-        dependencies: list[str],
+        dependencies: typing.Sequence[str],
         git_url: str,
         pkgbase: typing.Optional[str] = None,
-        provides: typing.Optional[list[str]] = None,
-        make_dependencies: typing.Optional[list[str]] = None,
-        check_dependencies: typing.Optional[list[str]] = None,
+        provides: typing.Optional[typing.Sequence[str]] = None,
+        make_dependencies: typing.Optional[typing.Sequence[str]] = None,
+        check_dependencies: typing.Optional[typing.Sequence[str]] = None,
     ):
         if pkgbase is None:
             pkgbase = pkgname
-        if provides is None:
-            provides = []
-        if make_dependencies is None:
-            make_dependencies = []
-        if check_dependencies is None:
-            check_dependencies = []
 
         self.pkgname = pkgname
         self.pkgbase = pkgbase
         self.version = version
-        self.provides = provides
-        self.dependencies = dependencies
-        self.make_dependencies = make_dependencies
-        self.check_dependencies = check_dependencies
+        # Dependencies are only read after the package is defined, so store them as tuples.
+        self.provides = tuple(provides or ())
+        self.dependencies = tuple(dependencies)
+        self.make_dependencies = tuple(make_dependencies or ())
+        self.check_dependencies = tuple(check_dependencies or ())
         self.git_url = git_url
 
     def __hash__(self) -> int:
-        return self.pkgname.__hash__()
+        return hash(self.pkgname)
 
     def __eq__(self, value: object, /) -> bool:
         if isinstance(value, self.__class__):
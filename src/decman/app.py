@@ -3,15 +3,19 @@ Module containing the CLI Application.
 """
 
 import argparse
+import marshal
 import os
 import sys
-import traceback
+import types
+import typing
 
 import decman
 import decman.error as err
 import decman.lib as l
 import decman.config as conf
-from decman.lib import fpm
+
+if typing.TYPE_CHECKING:
+    from decman.lib import fpm
 
 
 def main():
@@ -21,6 +25,56 @@ def main():
 
     sys.pycache_prefix = os.path.join(conf.pkg_cache_dir, "python/")
 
+    args = _build_parser().parse_args()
+
+    if not _is_root():
+        l.print_error("Not running as root. Please run decman as root.")
+        sys.exit(1)
+
+    original_wd = os.getcwd()
+
+    try:
+        store = l.Store.restore()
+    except err.UserFacingError as error:
+        l.print_error(error.user_facing_msg)
+        _print_traceback()
+        sys.exit(1)
+
+    errored = False
+
+    try:
+        opts = _set_up(store, args)
+        # Override debug_output if cli option is used
+        if args.debug:
+            conf.debug_output = True
+            conf.suppress_command_output = False
+        # When print cli option is used, show info output
+        if args.print:
+            conf.quiet_output = False
+        Core(store, opts).run()
+    except err.UserFacingError as error:
+        l.print_error(error.user_facing_msg)
+        _print_traceback()
+        errored = True
+    except decman.UserRaisedError as user_error:
+        l.print_error(
+            f"Error encountered while running the source: {user_error}")
+        errored = True
+
+    # Save even when an error has occurred, since this avoids repeating steps like building pkgs.
+    try:
+        store.save()
+    except err.UserFacingError as error:
+        l.print_error(error.user_facing_msg)
+        _print_traceback()
+        errored = True
+
+    os.chdir(original_wd)
+    if errored:
+        sys.exit(2)
+
+
+def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         prog="decman",
         description=
@@ -71,56 +125,107 @@ def main():
         default=False,
         help="force building of packages that are already cached")
 
-    args = parser.parse_args()
+    return parser
 
-    if not _is_root():
-        l.print_error("Not running as root. Please run decman as root.")
-        sys.exit(1)
 
-    original_wd = os.getcwd()
+def _print_traceback():
+    # The traceback is only shown as debug output, so don't format it otherwise.
+    if not conf.debug_output:
+        return
+
+    # Only needed when an error occurs, so traceback isn't imported on every run.
+    import traceback
+
+    for line in traceback.format_exc().splitlines():
+        l.print_debug(line)
 
+
+def _compile_source(source_path: str) -> types.CodeType:
+    """
+    Compiles the source file.
+
+    The compiled code is cached in the package cache directory along with the modification time
+    and size of the source, so an unchanged source isn't parsed again.
+    """
     try:
-        store = l.Store.restore()
-    except err.UserFacingError as error:
-        l.print_error(error.user_facing_msg)
-        for line in traceback.format_exc().splitlines():
-            l.print_debug(line)
-        sys.exit(1)
+        stat = os.stat(source_path)
+    except OSError as e:
+        raise err.UserFacingError(
+            f"Failed to read source file '{source_path}'.") from e
 
-    errored = False
+    # Only needed here, so importing it doesn't slow down the start of every run.
+    import hashlib
+
+    cache_key = f"{sys.implementation.cache_tag}:{source_path}"
+    cache_file = os.path.join(
+        conf.pkg_cache_dir, "python", "source",
+        hashlib.sha1(cache_key.encode("utf-8")).hexdigest())
 
     try:
-        opts = _set_up(store, args)
-        # Override debug_output if cli option is used
-        if args.debug:
-            conf.debug_output = True
-            conf.suppress_command_output = False
-        # When print cli option is used, show info output
-        if args.print:
-            conf.quiet_output = False
-        Core(store, opts).run()
-    except err.UserFacingError as error:
-        l.print_error(error.user_facing_msg)
-        for line in traceback.format_exc().splitlines():
-            l.print_debug(line)
-        errored = True
-    except decman.UserRaisedError as user_error:
-        l.print_error(
-            f"Error encountered while running the source: {user_error}")
-        errored = True
+        with open(cache_file, "rb") as file:
+            mtime_ns, size, code = marshal.load(file)
+        if mtime_ns == stat.st_mtime_ns and size == stat.st_size:
+            l.print_debug(f"Using compiled source from '{cache_file}'.")
+            return code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    # An unbuffered binary read fetches the whole file at once and compile decodes it.
+    try:
+        with open(source_path, "rb", buffering=0) as file:
+            content = file.read()
+    except OSError as e:
+        raise err.UserFacingError(
+            f"Failed to read source file '{source_path}'.") from e
+
+    code = compile(content, source_path, "exec")
 
-    # Save even when an error has occurred, since this avoids repeating steps like building pkgs.
     try:
-        store.save()
-    except err.UserFacingError as error:
-        l.print_error(error.user_facing_msg)
-        for line in traceback.format_exc().splitlines():
-            l.print_debug(line)
-        errored = True
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, "wb") as file:
+            marshal.dump((stat.st_mtime_ns, stat.st_size, code), file)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        l.print_debug(f"Failed to cache compiled source: {e}")
 
-    os.chdir(original_wd)
-    if errored:
-        sys.exit(2)
+    return code
+
+
+def _remove_files(files: list[str]):
+    """
+    Removes the given files. Failures are reported but don't stop removing the other files.
+
+    Files are grouped by their directory, so that each directory is looked up only once.
+    """
+
+    def report_failure(file: str, error: OSError):
+        # Errors are shown with the full path of the file instead of the name relative to its
+        # directory.
+        l.print_error(f"{OSError(error.errno, error.strerror, file)}")
+        l.print_warning(f"Failed to remove file: {file}")
+
+    by_dir: dict[str, list[str]] = {}
+    for file in files:
+        # Relative paths without a directory are relative to the working directory.
+        by_dir.setdefault(os.path.dirname(file) or ".", []).append(file)
+
+    for directory, dir_files in by_dir.items():
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            for file in dir_files:
+                report_failure(file, e)
+            continue
+
+        try:
+            for file in dir_files:
+                try:
+                    os.unlink(os.path.basename(file), dir_fd=dir_fd)
+                except OSError as e:
+                    report_failure(file, e)
+        finally:
+            os.close(dir_fd)
 
 
 def _set_up(store: l.Store, args):
@@ -153,16 +258,15 @@ def _set_up(store: l.Store, args):
     source_dir = os.path.dirname(source_path)
     store.source_file = source_path
 
-    try:
-        with open(source_path, "rt", encoding="utf-8") as file:
-            content = file.read()
-    except OSError as e:
-        raise err.UserFacingError(
-            f"Failed to read source file '{store.source_file}'.") from e
+    code = _compile_source(source_path)
 
     os.chdir(source_dir)
-    sys.path.append(".")
-    exec(content)
+    # The absolute directory keeps imports done later by modules working after the working
+    # directory is restored.
+    if source_dir not in sys.path:
+        sys.path.append(source_dir)
+    # The source gets its own namespace like a script run by python would.
+    exec(code, {"__name__": "__main__", "__file__": source_path})
 
     return args.print, not args.no_packages, not args.no_foreign_packages, not args.no_files, not args.no_systemd_units, not args.no_commands, args.upgrade_devel, args.force_build
 
@@ -179,14 +283,26 @@ class Core:
         self.source = _resolve_source()
         self.pacman = l.Pacman()
         self.systemctl = l.Systemd(store)
-        self.fpkg_search = fpm.ExtendedPackageSearch(self.pacman)
+        self._fpm: typing.Optional["fpm.ForeignPackageManager"] = None
+
+    def _foreign_package_manager(self) -> "fpm.ForeignPackageManager":
+        """
+        Creates the foreign package manager when it is first needed.
 
-        for upkg in self.source.all_user_pkgs():
-            self.fpkg_search.add_user_pkg(
-                fpm.PackageInfo.from_user_package(upkg, self.pacman))
+        Runs that don't touch foreign packages skip importing it and resolving user packages.
+        """
+        if self._fpm is None:
+            rpc_cache = os.path.join(conf.pkg_cache_dir, "aur_rpc_cache.json")
+            fpkg_search = l.fpm.ExtendedPackageSearch(self.pacman,
+                                                      cache_file=rpc_cache)
 
-        self.fpm = fpm.ForeignPackageManager(store, self.pacman,
-                                             self.fpkg_search)
+            for upkg in self.source.all_user_pkgs():
+                fpkg_search.add_user_pkg(
+                    l.fpm.PackageInfo.from_user_package(upkg, self.pacman))
+
+            self._fpm = l.fpm.ForeignPackageManager(self.store, self.pacman,
+                                                    fpkg_search)
+        return self._fpm
 
     def run(self):
         """
@@ -208,39 +324,45 @@ class Core:
 
         if self.run_commands:
             self._run_modules()
-            all_enabled_modules = {}
-            for mod, version in self.source.all_enabled_modules():
-                all_enabled_modules[mod] = version
             # Enabled modules are really only stored for commands,
             # so they can be set only when the commands were exacuted.
-            self.store.enabled_modules = all_enabled_modules
+            self.store.enabled_modules = dict(
+                self.source.all_enabled_modules())
+
+    def _print_and_apply(self, title: str, items: list[str], action, *args):
+        """
+        Prints the items and passes them to the action unless only printing or there are no items.
+        """
+        l.print_list(title, items)
+        if items and not self.only_print:
+            action(items, *args)
 
     def _disable_units(self):
-        to_disable = self.source.units_to_disable(self.store)
-        l.print_list("Disabling systemd units:", to_disable)
-        if not self.only_print:
-            self.systemctl.disable_units(to_disable)
+        self._print_and_apply("Disabling systemd units:",
+                              self.source.units_to_disable(self.store),
+                              self.systemctl.disable_units)
 
         user_units_to_disable = self.source.user_units_to_disable(self.store)
         for user, units in user_units_to_disable.items():
-            l.print_list(f"Disabling systemd units for {user}:", units)
-            if not self.only_print:
-                self.systemctl.disable_user_units(units, user)
+            self._print_and_apply(f"Disabling systemd units for {user}:",
+                                  units, self.systemctl.disable_user_units,
+                                  user)
 
     def _remove_pkgs(self):
         currently_installed = self.pacman.get_installed()
-        to_remove = self.source.packages_to_remove(currently_installed)
-        l.print_list("Removing packages:", to_remove)
-        if not self.only_print:
-            self.pacman.remove(to_remove)
+        self._print_and_apply(
+            "Removing packages:",
+            self.source.packages_to_remove(currently_installed),
+            self.pacman.remove)
 
     def _upgrade_pkgs(self):
         l.print_summary("Upgrading packages.")
         if not self.only_print:
             self.pacman.upgrade()
             if conf.enable_fpm and self.update_foreign_packages:
-                self.fpm.upgrade(self.upgrade_devel, self.force_build,
-                                 self.source.ignored_packages)
+                self._foreign_package_manager().upgrade(
+                    self.upgrade_devel, self.force_build,
+                    self.source.ignored_packages)
 
     def _install_pkgs(self):
         currently_installed = self.pacman.get_installed()
@@ -249,16 +371,15 @@ class Core:
         to_install_fpm = self.source.foreign_packages_to_install(
             currently_installed)
 
-        l.print_list("Installing pacman packages:", to_install_pacman)
+        self._print_and_apply("Installing pacman packages:", to_install_pacman,
+                              self.pacman.install)
 
         # fpm prints a summary so no need to print it twice
         if self.only_print:
             l.print_list("Installing foreign packages:", to_install_fpm)
-
-        if not self.only_print:
-            self.pacman.install(to_install_pacman)
-            if conf.enable_fpm and self.update_foreign_packages:
-                self.fpm.install(to_install_fpm, force=self.force_build)
+        elif conf.enable_fpm and self.update_foreign_packages:
+            self._foreign_package_manager().install(to_install_fpm,
+                                                    force=self.force_build)
 
     def _create_and_remove_files(self):
         l.print_summary("Installing files.")
@@ -274,26 +395,19 @@ class Core:
         if self.only_print:
             return
 
-        for file in to_remove:
-            try:
-                os.remove(file)
-            except OSError as e:
-                l.print_error(f"{e}")
-                l.print_warning(f"Failed to remove file: {file}")
+        _remove_files(to_remove)
 
         self.store.created_files = all_created
 
     def _enable_units(self):
-        to_enable = self.source.units_to_enable(self.store)
-        l.print_list("Enabling systemd units:", to_enable)
-        if not self.only_print:
-            self.systemctl.enable_units(to_enable)
+        self._print_and_apply("Enabling systemd units:",
+                              self.source.units_to_enable(self.store),
+                              self.systemctl.enable_units)
 
         user_units_to_enable = self.source.user_units_to_enable(self.store)
         for user, units in user_units_to_enable.items():
-            l.print_list(f"Enabling systemd units for {user}:", units)
-            if not self.only_print:
-                self.systemctl.enable_user_units(units, user)
+            self._print_and_apply(f"Enabling systemd units for {user}:", units,
+                                  self.systemctl.enable_user_units, user)
 
     def _run_modules(self):
         l.print_summary("Running on enable hooks.")
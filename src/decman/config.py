@@ -41,31 +41,39 @@ class Commands:
         """
         return ["pacman", "-Qm", "--color=never"]
 
+    def list_repo_pkgs(self) -> list[str]:
+        """
+        Running this command outputs a newline seperated list of all packages available in
+        pacman repositories.
+        """
+        return ["pacman", "-Slq"]
+
     def install_pkgs(self, pkgs: list[str]) -> list[str]:
         """
         Running this command installs the given packages from pacman repositories.
         """
-        return ["pacman", "-S", "--color=always", "--needed"] + pkgs
+        return ["pacman", "-S", "--color=always", "--needed", *pkgs]
 
     def install_files(self, pkg_files: list[str]) -> list[str]:
         """
         Running this command installs the given packages files.
         """
-        return ["pacman", "-U", "--color=always", "--asdeps"] + pkg_files
+        return ["pacman", "-U", "--color=always", "--asdeps", *pkg_files]
 
     def set_as_explicitly_installed(self, pkgs: list[str]) -> list[str]:
         """
         Running this command installs sets the given as explicitly installed.
         """
-        return ["pacman", "-D", "--color=always", "--asexplicit"] + pkgs
+        return ["pacman", "-D", "--color=always", "--asexplicit", *pkgs]
 
     def install_deps(self, deps: list[str]) -> list[str]:
         """
         Running this command installs the given packages from pacman repositories.
         The packages are installed as dependencies.
         """
-        return ["pacman", "-S", "--color=always", "--needed", "--asdeps"
-                ] + deps
+        return [
+            "pacman", "-S", "--color=always", "--needed", "--asdeps", *deps
+        ]
 
     def is_installable(self, pkg: str) -> list[str]:
         """
@@ -84,31 +92,31 @@ class Commands:
         Running this command removes the given packages and their dependencies
         (that aren't required by other packages).
         """
-        return ["pacman", "-Rs", "--color=always"] + pkgs
+        return ["pacman", "-Rs", "--color=always", *pkgs]
 
     def enable_units(self, units: list[str]) -> list[str]:
         """
         Running this command enables the given systemd units.
         """
-        return ["systemctl", "enable"] + units
+        return ["systemctl", "enable", *units]
 
     def disable_units(self, units: list[str]) -> list[str]:
         """
         Running this command disables the given systemd units.
         """
-        return ["systemctl", "disable"] + units
+        return ["systemctl", "disable", *units]
 
     def enable_user_units(self, units: list[str], user: str) -> list[str]:
         """
         Running this command enables the given systemd units for the user.
         """
-        return ["systemctl", "--user", "-M", f"{user}@", "enable"] + units
+        return ["systemctl", "--user", "-M", f"{user}@", "enable", *units]
 
     def disable_user_units(self, units: list[str], user: str) -> list[str]:
         """
         Running this command disables the given systemd units for the user.
         """
-        return ["systemctl", "--user", "-M", f"{user}@", "disable"] + units
+        return ["systemctl", "--user", "-M", f"{user}@", "disable", *units]
 
     def compare_versions(self, installed_version: str,
                          new_version: str) -> list[str]:
@@ -153,7 +161,7 @@ class Commands:
         Running this command creates a new arch chroot to the chroot directory and installs the
         given packages there.
         """
-        return ["mkarchroot", chroot_dir] + with_pkgs
+        return ["mkarchroot", chroot_dir, *with_pkgs]
 
     def install_chroot_packages(self, chroot_dir: str, packages: list[str]):
         """
@@ -161,15 +169,17 @@ class Commands:
         """
         return [
             "arch-nspawn", chroot_dir, "pacman", "-S", "--needed",
-            "--noconfirm"
-        ] + packages
+            "--noconfirm", *packages
+        ]
 
     def remove_chroot_packages(self, chroot_dir: str, packages: list[str]):
         """
         Running this command removes the given packages from the given chroot.
         """
-        return ["arch-nspawn", chroot_dir, "pacman", "-Rsu", "--noconfirm"
-                ] + packages
+        return [
+            "arch-nspawn", chroot_dir, "pacman", "-Rsu", "--noconfirm",
+            *packages
+        ]
 
     def make_chroot_pkg(self, chroot_wd_dir: str, user: str,
                         pkgfiles_to_install: list[str]) -> list[str]:
@@ -178,14 +188,11 @@ class Commands:
         The package is created as the user and the pkg_files_to_install are installed
         in the chroot before the package is created.
         """
-        makechrootpkg_cmd = [
-            "makechrootpkg", "-c", "-r", chroot_wd_dir, "-U", user
+        prefix = ("makechrootpkg", "-c", "-r", chroot_wd_dir, "-U", user)
+        install_args = [
+            arg for pkgfile in pkgfiles_to_install for arg in ("-I", pkgfile)
         ]
-
-        for pkgfile in pkgfiles_to_install:
-            makechrootpkg_cmd += ["-I", pkgfile]
-
-        return makechrootpkg_cmd
+        return [*prefix, *install_args]
 
 
 commands: Commands = Commands()
@@ -220,5 +227,6 @@ makepkg_user: str = "nobody"
 build_dir: str = "/tmp/decman/build"
 pkg_cache_dir: str = "/var/cache/decman"
 aur_rpc_timeout: typing.Optional[int] = 30
+aur_rpc_cache_ttl: typing.Optional[int] = None
 enable_fpm: bool = True
 number_of_packages_stored_in_cache: int = 3
@@ -3,6 +3,10 @@ Library module for decman.
 """
 
 import threading
+import codecs
+import functools
+import importlib
+import re
 import sys
 import shutil
 import subprocess
@@ -23,6 +27,7 @@ _GRAY_PREFIX = "\033[90m"
 _RESET_SUFFIX = "\033[m"
 _SPACING = "    "
 _CONTINUATION_PREFIX = f"{_DECMAN_MSG_TAG}{_SPACING} "
+_MAX_PARALLEL_PACMAN_QUERIES = 8
 
 INFO = 1
 SUMMARY = 2
@@ -74,14 +79,11 @@ def print_list(msg: str,
     if len(l) == 0:
         return
 
-    l = l.copy()
     if level == SUMMARY:
         print_summary(msg)
     elif level == INFO:
         print_info(msg)
 
-    print_continuation("", level=level)
-
     if elements_per_line is None:
         elements_per_line = len(l)
 
@@ -92,27 +94,23 @@ def print_list(msg: str,
         max_line_width = shutil.get_terminal_size().columns - len(
             _SPACING) - len(_CONTINUATION_PREFIX)
 
-    lines = [f"{l.pop(0)}"]
-    index = 0
+    elements = iter(l)
+    lines = [f"{next(elements)}"]
     elements_in_current_line = 1
-    while l:
-        next_element = l.pop(0)
-
+    for next_element in elements:
         can_fit_elements = elements_in_current_line + 1 <= elements_per_line
-        can_fit_text = len(lines[index]) + len(next_element) <= max_line_width
+        can_fit_text = len(lines[-1]) + len(next_element) <= max_line_width
 
         if can_fit_text and can_fit_elements:
-            lines[index] += f" {next_element}"
+            lines[-1] += f" {next_element}"
             elements_in_current_line += 1
         else:
             lines.append(f"{next_element}")
-            index += 1
             elements_in_current_line = 1
 
-    for line in lines:
-        print_continuation(line, level=level)
-
-    print_continuation("", level=level)
+    # Printed as a single block surrounded by empty lines instead of line by line.
+    print_continuation(f"\n{_CONTINUATION_PREFIX}".join(["", *lines, ""]),
+                       level=level)
 
 
 def print_info(msg: str):
@@ -188,6 +186,13 @@ _STORE_SAVE_DIR = "/var/lib/decman/"
 _STORE_SAVE_FILENAME = "/var/lib/decman/store.json"
 
 
+def __getattr__(name: str):
+    # The foreign package manager is only imported when it is first used.
+    if name == "fpm":
+        return importlib.import_module("decman.lib.fpm")
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
 class Store:
     """
     Stores information between decman invocations.
@@ -199,7 +204,9 @@ class Store:
         self.source_file: typing.Optional[str] = None
         self.allow_running_source_without_prompt: bool = False
         self.enabled_systemd_units: list[str] = []
-        self._enabled_user_systemd_units: list[str] = []
+        # Stored as "user->unit" entries. Kept as a set, since units are looked up and removed
+        # one by one, and saved as a sorted list.
+        self._enabled_user_systemd_units: set[str] = set()
         self.enabled_modules: dict[str, str] = {}
         self.created_files: list[str] = []
         self.pkgbuild_latest_reviewed_commits: dict[str, str] = {}
@@ -209,16 +216,13 @@ class Store:
         """
         Stores a user unit as enabled.
         """
-        self._enabled_user_systemd_units.append(f"{user}->{unit}")
+        self._enabled_user_systemd_units.add(f"{user}->{unit}")
 
     def remove_enabled_user_systemd_unit(self, user: str, unit: str):
         """
         Removes a user unit from stored units.
         """
-        try:
-            self._enabled_user_systemd_units.remove(f"{user}->{unit}")
-        except ValueError:
-            pass
+        self._enabled_user_systemd_units.discard(f"{user}->{unit}")
 
     def is_systemd_used_unit_enabled(self, user: str, unit: str) -> bool:
         """
@@ -232,9 +236,7 @@ class Store:
         """
         result = []
         for unit_str in self._enabled_user_systemd_units:
-            unit_l = unit_str.split("->")
-            user = unit_l[0]
-            unit = unit_l[1]
+            user, _, unit = unit_str.partition("->")
             result.append((user, unit))
         return result
 
@@ -335,7 +337,8 @@ class Store:
             "allow_running_source_without_prompt":
             self.allow_running_source_without_prompt,
             "enabled_systemd_units": self.enabled_systemd_units,
-            "enabled_user_systemd_units": self._enabled_user_systemd_units,
+            "enabled_user_systemd_units":
+            sorted(self._enabled_user_systemd_units),
             "enabled_modules": self.enabled_modules,
             "created_files": self.created_files,
             "package_file_cache": self._package_file_cache,
@@ -375,10 +378,11 @@ class Store:
                     "enabled_systemd_units",
                     [],
                 )
-                store._enabled_user_systemd_units = d.get(
-                    "enabled_user_systemd_units",
-                    [],
-                )
+                store._enabled_user_systemd_units = set(
+                    d.get(
+                        "enabled_user_systemd_units",
+                        [],
+                    ))
                 store.enabled_modules = d.get("enabled_modules", {})
                 store.created_files = d.get("created_files", [])
                 store._package_file_cache = d.get("package_file_cache", {})
@@ -425,12 +429,25 @@ class Source:
         self.directories = directories
         self.modules = modules
 
+        # Combined from the source and enabled modules when first needed, so that module
+        # methods are called only once.
+        self._all_pacman_pkgs_cache: typing.Optional[frozenset[str]] = None
+        self._all_foreign_pkgs_cache: typing.Optional[frozenset[str]] = None
+        self._all_user_pkgs_cache: typing.Optional[frozenset[
+            decman.UserPackage]] = None
+        self._all_pkgs_cache: typing.Optional[frozenset[str]] = None
+        self._all_units_cache: typing.Optional[frozenset[str]] = None
+        self._all_user_units_cache: typing.Optional[dict[
+            str, frozenset[str]]] = None
+        self._enabled_modules_cache: typing.Optional[tuple[decman.Module,
+                                                           ...]] = None
+
     def run_on_enable(self, store: Store):
         """
         Runs on_enable of every module that was now enabled.
         """
-        for module in self.modules:
-            if module.enabled and module.name not in store.enabled_modules:
+        for module in self._enabled_modules():
+            if module.name not in store.enabled_modules:
                 module.on_enable()
 
     def run_on_disable(self, store: Store):
@@ -445,19 +462,16 @@ class Source:
         """
         Runs after_update of every enabled module.
         """
-        for module in self.modules:
-            if module.enabled:
-                module.after_update()
+        for module in self._enabled_modules():
+            module.after_update()
 
     def run_after_version_change(self, store: Store):
         """
         Runs after_version_change of every enabled module that has it's version changed.
         """
-        for module in self.modules:
-            if module.enabled and module.version != store.enabled_modules.get(
-                    module.name, module.version):
-                module.after_version_change()
-            elif module.enabled and module.name not in store.enabled_modules:
+        for module in self._enabled_modules():
+            # Modules that weren't enabled before have no stored version.
+            if store.enabled_modules.get(module.name) != module.version:
                 module.after_version_change()
 
     def create_all_files(self, only_print: bool) -> list[str]:
@@ -498,10 +512,10 @@ class Source:
         install_files(self.files)
         install_dirs(self.directories)
 
-        for module in self.modules:
-            if module.enabled:
-                install_files(module.files(), module.file_variables())
-                install_dirs(module.directories(), module.file_variables())
+        for module in self._enabled_modules():
+            variables = module.file_variables()
+            install_files(module.files(), variables)
+            install_dirs(module.directories(), variables)
 
         return created_files
 
@@ -512,9 +526,8 @@ class Source:
         all_files = []
         all_files.extend(self.files.keys())
 
-        for module in self.modules:
-            if module.enabled:
-                all_files.extend(module.files().keys())
+        for module in self._enabled_modules():
+            all_files.extend(module.files().keys())
 
         return all_files
 
@@ -525,9 +538,8 @@ class Source:
         all_dirs = []
         all_dirs.extend(self.directories.keys())
 
-        for module in self.modules:
-            if module.enabled:
-                all_dirs.extend(module.directories().keys())
+        for module in self._enabled_modules():
+            all_dirs.extend(module.directories().keys())
 
         return all_dirs
 
@@ -536,55 +548,44 @@ class Source:
         """
         Returns all files that should be removed.
         """
-        to_remove = []
-        for path in store.created_files:
-            if path not in created_files:
-                to_remove.append(path)
-        return to_remove
+        created = frozenset(created_files)
+        return [path for path in store.created_files if path not in created]
 
     def units_to_enable(self, store: Store) -> list[str]:
         """
         Returns all systemd units that should be enabled.
         """
-        result = []
-        for unit in self._all_units():
-            if unit not in store.enabled_systemd_units:
-                result.append(unit)
-        return result
+        return sorted(self._all_units().difference(
+            store.enabled_systemd_units))
 
     def units_to_disable(self, store: Store) -> list[str]:
         """
         Returns all systemd units that should be disabled.
         """
-        result = []
-        for unit in store.enabled_systemd_units:
-            if unit not in self._all_units():
-                result.append(unit)
-        return result
+        return sorted(set(store.enabled_systemd_units) - self._all_units())
 
     def user_units_to_enable(self, store: Store) -> dict[str, list[str]]:
         """
         Returns all user systemd units that should be enabled.
         """
+        enabled = self._enabled_user_units(store)
         result = {}
         for user, units in self._all_user_units().items():
-            for unit in units:
-                if not store.is_systemd_used_unit_enabled(user, unit):
-                    entry = result.get(user, [])
-                    entry.append(unit)
-                    result[user] = entry
+            to_enable = units - enabled.get(user, set())
+            if to_enable:
+                result[user] = sorted(to_enable)
         return result
 
     def user_units_to_disable(self, store: Store) -> dict[str, list[str]]:
         """
         Returns all user systemd units that should be disabled.
         """
+        all_user_units = self._all_user_units()
         result = {}
-        for user, unit in store.get_enabled_user_systemd_units():
-            if unit not in self._all_user_units().get(user, set()):
-                entry = result.get(user, [])
-                entry.append(unit)
-                result[user] = entry
+        for user, units in self._enabled_user_units(store).items():
+            to_disable = units - all_user_units.get(user, set())
+            if to_disable:
+                result[user] = sorted(to_disable)
         return result
 
     def packages_to_remove(
@@ -592,99 +593,110 @@ class Source:
         """
         Returns all packages that should be removed. This includes pacman, aur and user packages.
         """
-        result = []
-        for pkg in currently_installed_packages:
-            if pkg in self.ignored_packages:
-                continue
-            if pkg not in self._all_pkgs():
-                result.append(pkg)
-        return result
+        to_keep = self._all_pkgs() | self.ignored_packages
+        return [
+            pkg for pkg in currently_installed_packages if pkg not in to_keep
+        ]
 
     def pacman_packages_to_install(
             self, currently_installed_packages: list[str]) -> list[str]:
         """
         Returns all pacman packages that should be installed.
         """
-        result = []
-        for pkg in self._all_pacman_pkgs():
-            if pkg in self.ignored_packages:
-                continue
-            if pkg not in currently_installed_packages:
-                result.append(pkg)
-        return result
+        return sorted(self._all_pacman_pkgs().difference(
+            self.ignored_packages, currently_installed_packages))
 
     def foreign_packages_to_install(
             self, currently_installed_packages: list[str]) -> list[str]:
         """
         Returns all aur and user packages that should be installed.
         """
-        result = []
-        for pkg in self._all_foreign_pkgs():
-            if pkg in self.ignored_packages:
-                continue
-            if pkg not in currently_installed_packages:
-                result.append(pkg)
-        return result
+        return sorted(self._all_foreign_pkgs().difference(
+            self.ignored_packages, currently_installed_packages))
 
     def all_enabled_modules(self) -> list[tuple[str, str]]:
         """
         Returns all enabled modules and their versions.
         """
         result = []
-        for module in self.modules:
-            if module.enabled:
-                result.append((module.name, module.version))
+        for module in self._enabled_modules():
+            result.append((module.name, module.version))
         return result
 
-    def all_user_pkgs(self) -> set[decman.UserPackage]:
+    def _enabled_modules(self) -> tuple[decman.Module, ...]:
+        if self._enabled_modules_cache is None:
+            self._enabled_modules_cache = tuple(module
+                                                for module in self.modules
+                                                if module.enabled)
+        return self._enabled_modules_cache
+
+    def all_user_pkgs(self) -> frozenset[decman.UserPackage]:
         """
         Returns all active UserPackages.
         """
-        result = set()
-        result.update(self.user_packages)
-        for module in self.modules:
-            if module.enabled:
+        if self._all_user_pkgs_cache is None:
+            result = set()
+            result.update(self.user_packages)
+            for module in self._enabled_modules():
                 result.update(module.user_packages())
-        return result
-
-    def _all_pacman_pkgs(self) -> set[str]:
-        result = set()
-        result.update(self.pacman_packages)
-        for module in self.modules:
-            if module.enabled:
+            self._all_user_pkgs_cache = frozenset(result)
+        return self._all_user_pkgs_cache
+
+    def _all_pacman_pkgs(self) -> frozenset[str]:
+        if self._all_pacman_pkgs_cache is None:
+            result = set()
+            result.update(self.pacman_packages)
+            for module in self._enabled_modules():
                 result.update(module.pacman_packages())
-        return result
-
-    def _all_foreign_pkgs(self) -> set[str]:
-        result = set()
-        result.update(self.aur_packages)
-        result.update(map(lambda p: p.pkgname, self.user_packages))
-        for module in self.modules:
-            if module.enabled:
+            self._all_pacman_pkgs_cache = frozenset(result)
+        return self._all_pacman_pkgs_cache
+
+    def _all_foreign_pkgs(self) -> frozenset[str]:
+        if self._all_foreign_pkgs_cache is None:
+            result = set()
+            result.update(self.aur_packages)
+            for module in self._enabled_modules():
                 result.update(module.aur_packages())
-                result.update(map(lambda p: p.pkgname, module.user_packages()))
-        return result
-
-    def _all_pkgs(self) -> set[str]:
-        result = set()
-        result.update(self._all_pacman_pkgs())
-        result.update(self._all_foreign_pkgs())
-        return result
-
-    def _all_units(self) -> set[str]:
-        result = set()
-        result.update(self.systemd_units)
-        for module in self.modules:
-            if module.enabled:
+            result.update(upkg.pkgname for upkg in self.all_user_pkgs())
+            self._all_foreign_pkgs_cache = frozenset(result)
+        return self._all_foreign_pkgs_cache
+
+    def _all_pkgs(self) -> frozenset[str]:
+        if self._all_pkgs_cache is None:
+            pacman_pkgs = self._all_pacman_pkgs()
+            self._all_pkgs_cache = pacman_pkgs | self._all_foreign_pkgs()
+        return self._all_pkgs_cache
+
+    def _all_units(self) -> frozenset[str]:
+        if self._all_units_cache is None:
+            result = set()
+            result.update(self.systemd_units)
+            for module in self._enabled_modules():
                 result.update(module.systemd_units())
-        return result
+            self._all_units_cache = frozenset(result)
+        return self._all_units_cache
+
+    def _all_user_units(self) -> dict[str, frozenset[str]]:
+        if self._all_user_units_cache is None:
+            result = {}
+            sources = [self.systemd_user_units] + [
+                module.systemd_user_units()
+                for module in self._enabled_modules()
+            ]
+            for user_units in sources:
+                for user, units in user_units.items():
+                    result.setdefault(user, set()).update(units)
+            self._all_user_units_cache = {
+                user: frozenset(units)
+                for user, units in result.items()
+            }
+        return self._all_user_units_cache
 
-    def _all_user_units(self) -> dict[str, set[str]]:
+    @staticmethod
+    def _enabled_user_units(store: Store) -> dict[str, set[str]]:
         result = {}
-        result.update(self.systemd_user_units)
-        for module in self.modules:
-            if module.enabled:
-                result.update(module.systemd_user_units())
+        for user, unit in store.get_enabled_user_systemd_units():
+            result.setdefault(user, set()).add(unit)
         return result
 
 
@@ -694,20 +706,31 @@ class Pacman:
     """
 
     def __init__(self):
-        self._installable = {}
+        self._installable: dict[str, bool] = {}
+        self._repo_pkgs: typing.Optional[frozenset[str]] = None
+        # Package lists are cached until pacman is used to change installed packages
+        self._installed: typing.Optional[list[str]] = None
+        self._versioned_foreign: typing.Optional[list[tuple[str, str]]] = None
+
+    def _invalidate_installed(self):
+        self._installed = None
+        self._versioned_foreign = None
 
     def get_installed(self) -> list[str]:
         """
         Returns a list of installed packages.
         """
+        if self._installed is not None:
+            return list(self._installed)
 
         try:
             packages = subprocess.run(
                 conf.commands.list_pkgs(),
                 check=True,
                 stdout=subprocess.PIPE,
-            ).stdout.decode().strip().split('\n')
-            return packages
+            ).stdout.decode().strip().splitlines()
+            self._installed = packages
+            return list(packages)
         except subprocess.CalledProcessError as error:
             raise err.UserFacingError(
                 f"Failed to get installed packages using '{error.cmd}'. Output: {error.stdout}."
@@ -717,37 +740,97 @@ class Pacman:
         """
         Returns True if a dependency can be installed using pacman.
         """
-        if dep in self._installable:
-            return self._installable[dep]
+        result = self._installable.get(dep)
+        if result is not None:
+            return result
 
-        result = subprocess.run(conf.commands.is_installable(dep),
-                                check=False,
-                                capture_output=True).returncode == 0
+        # Plain package names can be answered from the repository package list, but
+        # versioned and virtual dependencies still need pacman to resolve them.
+        if dep in self._get_repo_pkgs():
+            self._installable[dep] = True
+            return True
+
+        result = self._query_installable(dep)
         self._installable[dep] = result
         return result
 
+    def prefetch_installable(self, deps: typing.Iterable[str]):
+        """
+        Checks if the given dependencies can be installed using pacman in parallel, so that later
+        is_installable calls don't have to run pacman one dependency at a time.
+        """
+        repo_pkgs = self._get_repo_pkgs()
+        unknown = [
+            dep for dep in set(deps)
+            if dep not in self._installable and dep not in repo_pkgs
+        ]
+        if len(unknown) < 2:
+            return
+
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=_MAX_PARALLEL_PACMAN_QUERIES) as executor:
+            for dep, result in zip(
+                    unknown, executor.map(self._query_installable, unknown)):
+                self._installable[dep] = result
+
+    def _query_installable(self, dep: str) -> bool:
+        return subprocess.run(conf.commands.is_installable(dep),
+                              check=False,
+                              capture_output=True).returncode == 0
+
+    def _get_repo_pkgs(self) -> frozenset[str]:
+        if self._repo_pkgs is None:
+            # A customized is_installable command must decide every dependency by itself.
+            default_command = type(
+                conf.commands).is_installable is conf.Commands.is_installable
+            if not default_command:
+                self._repo_pkgs = frozenset()
+                return self._repo_pkgs
+
+            process = subprocess.run(conf.commands.list_repo_pkgs(),
+                                     check=False,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+            if process.returncode == 0:
+                self._repo_pkgs = frozenset(
+                    process.stdout.decode().splitlines())
+            else:
+                print_debug(
+                    "Failed to list repository packages. Checking packages individually."
+                )
+                self._repo_pkgs = frozenset()
+        return self._repo_pkgs
+
     def get_versioned_foreign_packages(self) -> list[tuple[str, str]]:
         """
         Returns a list of installed packages and their versions that aren't from pacman databases,
         basically AUR packages.
         """
+        if self._versioned_foreign is not None:
+            return list(self._versioned_foreign)
+
         try:
             output = subprocess.run(
                 conf.commands.list_foreign_pkgs_versioned(),
                 check=True,
-                stdout=subprocess.PIPE).stdout.decode().strip().split('\n')
+                stdout=subprocess.PIPE).stdout.decode().strip().splitlines()
         except subprocess.CalledProcessError as error:
             raise err.UserFacingError(
                 f"Failed to get foreign packages using '{error.cmd}'. Output: {error.stdout}."
             ) from error
 
-        try:
-            return [(line.split(" ")[0], line.split(" ")[1])
-                    for line in output]
-        except IndexError as error:
-            raise err.UserFacingError(
-                f"Failed to parse foreign packages from pacman output. Output: {output}"
-            ) from error
+        result = []
+        for line in output:
+            package, sep, version = line.partition(" ")
+            if not sep:
+                raise err.UserFacingError(
+                    f"Failed to parse foreign packages from pacman output. Output: {output}"
+                )
+            result.append((package, version))
+        self._versioned_foreign = result
+        return list(result)
 
     def install(self, packages: list[str]):
         """
@@ -756,6 +839,7 @@ class Pacman:
         if not packages:
             return
 
+        self._invalidate_installed()
         returncode, output = echo_and_capture_command(
             conf.commands.install_pkgs(packages))
         if returncode != 0:
@@ -781,6 +865,7 @@ class Pacman:
         if not deps:
             return
 
+        self._invalidate_installed()
         returncode, output = echo_and_capture_command(
             conf.commands.install_deps(deps))
         if returncode != 0:
@@ -798,6 +883,7 @@ class Pacman:
         if not files:
             return
 
+        self._invalidate_installed()
         returncode, output = echo_and_capture_command(
             conf.commands.install_files(files))
         if returncode != 0:
@@ -825,6 +911,9 @@ class Pacman:
         """
         Upgrades all packages.
         """
+        self._invalidate_installed()
+        # Syncing the databases may change which packages are available
+        self._repo_pkgs = None
         returncode, output = echo_and_capture_command(conf.commands.upgrade())
         if returncode != 0:
             raise err.UserFacingError(
@@ -840,6 +929,7 @@ class Pacman:
         if not packages:
             return
 
+        self._invalidate_installed()
         returncode, output = echo_and_capture_command(
             conf.commands.remove(packages))
         if returncode != 0:
@@ -855,20 +945,28 @@ def print_highlighted_pacman_messages(output: str):
     Prints lines that contain pacman output keywords.
     """
     print_summary("Pacman output highlights:")
-    lines = output.split("\n")
+    keyword_rx = _keyword_regex(tuple(conf.pacman_output_keywords))
+    if keyword_rx is None:
+        return
+
+    lines = output.splitlines()
     for index, line in enumerate(lines):
-        for keyword in conf.pacman_output_keywords:
-            if keyword.lower() in line.lower():
-                print_summary(f"lines: {index}-{index+2}")
-                if index >= 1:
-                    print_continuation(lines[index - 1])
-                print_continuation(line)
-                if index + 1 < len(lines):
-                    print_continuation(lines[index + 1])
-                print_continuation("")
+        # A line is printed once even if it contains multiple keywords
+        if keyword_rx.search(line):
+            print_summary(f"lines: {index}-{index+2}")
+            if index >= 1:
+                print_continuation(lines[index - 1])
+            print_continuation(line)
+            if index + 1 < len(lines):
+                print_continuation(lines[index + 1])
+            print_continuation("")
+
 
-                # Break, as to not print the same line again if it contains multiple keywords
-                break
+@functools.lru_cache(maxsize=None)
+def _keyword_regex(keywords: tuple[str, ...]) -> typing.Optional[re.Pattern]:
+    if not keywords:
+        return None
+    return re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
 
 
 def echo_and_capture_command(program: list[str]) -> tuple[int, str]:
@@ -904,12 +1002,9 @@ def echo_and_capture_command(program: list[str]) -> tuple[int, str]:
         output_thread.join()
 
         # Capture any output that may not have been yet captured
-        output = output_thread.output
-        missing_output = process.stdout.read()
-        if missing_output:
-            output += missing_output.decode()
+        output_thread.finish(process.stdout.read() or b"")
 
-        return (process.returncode, output)
+        return (process.returncode, output_thread.output)
 
 
 class _OutputCapturingThread(threading.Thread):
@@ -917,15 +1012,32 @@ class _OutputCapturingThread(threading.Thread):
     def __init__(self, stream):
         super().__init__()
         self._stream = stream
-        self.output = ""
+        self._chunks: list[str] = []
+        # Reads may split multi-byte characters, so decode incrementally
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
         self.done = False
 
+    @property
+    def output(self) -> str:
+        """
+        All output captured so far.
+        """
+        return "".join(self._chunks)
+
+    def finish(self, rest: bytes):
+        """
+        Decodes the remaining output along with any partial character left from earlier reads.
+
+        Must be called after the thread has stopped.
+        """
+        self._chunks.append(self._decoder.decode(rest, final=True))
+
     def run(self):
         while not self.done and not self._stream.closed:
             output = self._stream.read(1000)
             if output:
-                output = output.decode()
-                self.output += output
+                output = self._decoder.decode(output)
+                self._chunks.append(output)
                 print(output, end="", flush=True)
             time.sleep(0.1)
 
@@ -968,11 +1080,11 @@ class Systemd:
         except subprocess.CalledProcessError as error:
             raise err.UserFacingError(
                 f"Failed to disable systemd units: {units}") from error
-        for unit in units:
-            try:
-                self.state.enabled_systemd_units.remove(unit)
-            except ValueError:
-                pass
+        disabled = set(units)
+        self.state.enabled_systemd_units = [
+            unit for unit in self.state.enabled_systemd_units
+            if unit not in disabled
+        ]
 
     def enable_user_units(self, units: list[str], user: str):
         """
@@ -11,44 +11,107 @@ Terminology:
 - all dependencies: normal dependencies and build dependencies combined
 """
 
+import concurrent.futures
+import functools
 import shutil
 import subprocess
+import sys
 import os
 import re
+import json
+import time
+import threading
 import typing
 
-import requests
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyalpm
+except ImportError:
+    pyalpm = None
 
 import decman
 import decman.config as conf
 import decman.lib as l
 import decman.error as err
 
+if typing.TYPE_CHECKING:
+    import requests
+
+_AUR_RPC_INFO_URL = "https://aur.archlinux.org/rpc/v5/info"
+_MAX_PARALLEL_AUR_REQUESTS = 4
+_DEP_VERSION_RX = re.compile("[=<>].*")
+_DEVEL_SUFFIXES = (
+    "-git",
+    "-hg",
+    "-bzr",
+    "-svn",
+    "-cvs",
+    "-darcs",
+)
+
+# Many AUR packages share identical dependency lists, so equal tuples are stored only once.
+_DEPS_INTERN: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+class _AurRpcError(Exception):
+    """
+    Raised when a request to the AUR RPC fails.
+    """
+
 
+@functools.lru_cache(maxsize=None)
 def strip_dependency(dep: str) -> str:
     """
     Removes version spefications from a dependency name.
     """
-    rx = re.compile("(=.*|>.*|<.*)")
-    return rx.sub("", dep)
+    return _DEP_VERSION_RX.sub("", dep)
 
 
 def is_devel(package: str) -> bool:
     """
     Returns True if the given package is a devel package.
     """
-    devel_suffixes = [
-        "-git",
-        "-hg",
-        "-bzr",
-        "-svn",
-        "-cvs",
-        "-darcs",
-    ]
-    for suffix in devel_suffixes:
-        if package.endswith(suffix):
-            return True
-    return False
+    return package.endswith(_DEVEL_SUFFIXES)
+
+
+def _compare_versions(installed_version: str, new_version: str) -> int:
+    # Use libalpm directly unless the user has customized the vercmp command.
+    default_command = type(
+        conf.commands).compare_versions is conf.Commands.compare_versions
+    if pyalpm is not None and default_command:
+        return pyalpm.vercmp(installed_version, new_version)
+
+    return int(
+        subprocess.run(conf.commands.compare_versions(installed_version,
+                                                      new_version),
+                       check=True,
+                       stdout=subprocess.PIPE).stdout.decode())
+
+
+def _intern_deps(deps: tuple[str, ...]) -> tuple[str, ...]:
+    return _DEPS_INTERN.setdefault(deps, deps)
+
+
+def _split_dependencies(
+        deps: typing.Sequence[str],
+        pacman: l.Pacman) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """
+    Splits dependencies into ones installable with pacman and stripped foreign dependencies.
+    """
+    pacman_deps = []
+    foreign_deps_stripped = []
+    for dep in deps:
+        if pacman.is_installable(dep):
+            pacman_deps.append(dep)
+        else:
+            foreign_deps_stripped.append(sys.intern(strip_dependency(dep)))
+    pacman_deps = _intern_deps(tuple(pacman_deps))
+    foreign_deps_stripped = _intern_deps(tuple(foreign_deps_stripped))
+    return pacman_deps, foreign_deps_stripped
 
 
 class PackageInfo:
@@ -58,43 +121,35 @@ class PackageInfo:
     In case of AUR packages, these are fetched from AUR RPC.
     """
 
+    __slots__ = ("pkgname", "pkgbase", "version", "provides", "git_url",
+                 "pacman_dependencies", "foreign_dependencies_stripped",
+                 "pacman_make_dependencies",
+                 "foreign_make_dependencies_stripped",
+                 "pacman_check_dependencies",
+                 "foreign_check_dependencies_stripped")
+
     def __init__(self, pkgname: str, pkgbase: str, version: str,
-                 provides: list[str], dependencies: list[str],
-                 make_dependencies: list[str], check_dependencies: list[str],
-                 git_url: str, pacman: l.Pacman):
-        self.pkgname = pkgname
-        self.pkgbase = pkgbase
+                 provides: typing.Sequence[str],
+                 dependencies: typing.Sequence[str],
+                 make_dependencies: typing.Sequence[str],
+                 check_dependencies: typing.Sequence[str], git_url: str,
+                 pacman: l.Pacman):
+        # Names are used as keys all over dependency resolution, so share a single copy of each.
+        self.pkgname = sys.intern(pkgname)
+        self.pkgbase = sys.intern(pkgbase)
         self.version = version
-        self.provides = provides
+        self.provides = _intern_deps(tuple(provides))
         self.git_url = git_url
 
-        self.foreign_dependencies_stripped = []
-        self.foreign_make_dependencies_stripped = []
-        self.foreign_check_dependencies_stripped = []
-        self.pacman_dependencies = []
-        self.pacman_make_dependencies = []
-        self.pacman_check_dependencies = []
-
-        for dep in dependencies:
-            if pacman.is_installable(dep):
-                self.pacman_dependencies.append(dep)
-            else:
-                self.foreign_dependencies_stripped.append(
-                    strip_dependency(dep))
-
-        for make_dep in make_dependencies:
-            if pacman.is_installable(make_dep):
-                self.pacman_make_dependencies.append(make_dep)
-            else:
-                self.foreign_make_dependencies_stripped.append(
-                    strip_dependency(make_dep))
+        self.pacman_dependencies, self.foreign_dependencies_stripped = _split_dependencies(
+            dependencies, pacman)
+        self.pacman_make_dependencies, self.foreign_make_dependencies_stripped = _split_dependencies(
+            make_dependencies, pacman)
+        self.pacman_check_dependencies, self.foreign_check_dependencies_stripped = _split_dependencies(
+            check_dependencies, pacman)
 
-        for check_dep in check_dependencies:
-            if pacman.is_installable(check_dep):
-                self.pacman_check_dependencies.append(check_dep)
-            else:
-                self.foreign_check_dependencies_stripped.append(
-                    strip_dependency(check_dep))
+    def __str__(self) -> str:
+        return f"{self.pkgname}"
 
     def pkg_file_prefix(self) -> str:
         """
@@ -173,10 +228,18 @@ class DepNode:
         """
         Returns True if the given package name is in the parents of this DepNode.
         """
-        for name, parent in self.parents.items():
-            if name == pkgname or parent.is_pkgname_in_parents_recursive(
-                    pkgname):
-                return True
+        # Iterative walk that visits every ancestor once, even when they are shared
+        # by multiple paths.
+        visited = set()
+        to_visit = [self]
+        while to_visit:
+            node = to_visit.pop()
+            for name, parent in node.parents.items():
+                if name == pkgname:
+                    return True
+                if name not in visited:
+                    visited.add(name)
+                    to_visit.append(parent)
         return False
 
 
@@ -208,7 +271,13 @@ class DepGraph:
 
         parent_node = self.package_nodes[parent_pkgname]
 
-        if parent_node.is_pkgname_in_parents_recursive(child_pkgname):
+        # A cycle is only possible if the child already has dependencies of its own.
+        # Existing connections have already been checked.
+        may_create_cycle = len(child_node.children) != 0 \
+            and parent_pkgname not in child_node.parents
+
+        if may_create_cycle and parent_node.is_pkgname_in_parents_recursive(
+                child_pkgname):
             raise err.UserFacingError(
                 f"Foreign package dependency cycle detected involving '{child_pkgname}' \
 and '{parent_pkgname}'. Foreign package dependencies are also required \
@@ -229,10 +298,11 @@ during package building and therefore dependency cycles cannot be handled.")
         for childless_node_name in self._childless_node_names:
             childless_node = self.package_nodes[childless_node_name]
 
+            # Same for every parent, so compute it once per node
+            new_deps = childless_node.pkg.get_all_recursive_foreign_dep_pkgs()
+            new_deps.add(childless_node.pkg.name)
+
             for parent in childless_node.parents.values():
-                new_deps = childless_node.pkg.get_all_recursive_foreign_dep_pkgs(
-                )
-                new_deps.add(childless_node.pkg.name)
                 parent.pkg.add_foreign_dependency_packages(new_deps)
                 del parent.children[childless_node_name]
                 if len(parent.children) == 0:
@@ -248,21 +318,49 @@ class ExtendedPackageSearch:
     Allows searcing for packages / providers from the AUR as well as user defined sources.
 
     Results are cached and user defined packages are preferred.
+
+    If cache_file is given and conf.aur_rpc_cache_ttl is set, AUR RPC results are also kept in
+    that file between decman runs for that many seconds. Call save_cache to write new results.
     """
 
-    def __init__(self, pacman: l.Pacman):
+    def __init__(self,
+                 pacman: l.Pacman,
+                 cache_file: typing.Optional[str] = None):
         self._pacman = pacman
         self._package_info_cache: dict[str, PackageInfo] = {}
         self._dep_provider_cache: dict[str, PackageInfo] = {}
-        self._user_packages: list[PackageInfo] = []
+        self._user_packages: dict[str, PackageInfo] = {}
+        # Providers are kept in insertion ordered dicts, so that each package is listed once
+        # even if it provides the same name with and without a version.
+        self._user_pkg_providers: dict[str, dict[str, None]] = {}
+
+        # Created on first use, since requests is slow to import and many runs never need it.
+        self._session: typing.Optional["requests.Session"] = None
+        self._session_lock = threading.Lock()
+
+        self._cache_file = cache_file
+        self._aur_result_cache: dict[str, tuple[float, dict]] = {}
+        self._aur_result_cache_changed = False
+        if cache_file is not None:
+            self._load_aur_result_cache()
 
     def add_user_pkg(self, user_pkg: PackageInfo):
         """
         Adds the given package to user packages.
         """
-        self._user_packages.append(user_pkg)
-
-    def try_caching_packages(self, packages: list[str]):
+        self._user_packages[user_pkg.pkgname] = user_pkg
+        for provided in user_pkg.provides:
+            self._user_pkg_providers.setdefault(provided,
+                                                {})[user_pkg.pkgname] = None
+
+            # Dependencies are looked up stripped, so versioned provides must be indexed
+            # by their name as well.
+            stripped = strip_dependency(provided)
+            if stripped != provided:
+                self._user_pkg_providers.setdefault(
+                    stripped, {})[user_pkg.pkgname] = None
+
+    def try_caching_packages(self, packages: typing.Iterable[str]):
         """
         Tried caching the given packages. Virtual packages may not be cached.
 
@@ -270,64 +368,205 @@ class ExtendedPackageSearch:
         times, because then those methods don't have to make new AUR RPC requests.
         """
 
-        packages = list(
-            filter(lambda p: p not in self._package_info_cache, packages))
+        # dict.fromkeys drops duplicates while keeping the order of the packages.
+        packages = [
+            p for p in dict.fromkeys(packages)
+            if p not in self._package_info_cache
+        ]
 
         if len(packages) == 0:
             return
 
         l.print_debug(f"Trying to cache {packages}.")
 
-        max_pkgs_per_request = 200
+        results_on_disk = []
+        not_cached_on_disk = []
+        for pkg in packages:
+            result = self._get_fresh_aur_result(pkg)
+            if result is None:
+                not_cached_on_disk.append(pkg)
+            else:
+                l.print_debug(f"'{pkg}' found in the AUR RPC cache.")
+                results_on_disk.append(result)
+        self._cache_aur_results(results_on_disk)
+        packages = not_cached_on_disk
 
-        while packages:
-            to_request = map(lambda p: f"arg[]={p}",
-                             packages[:max_pkgs_per_request])
-            packages = packages[max_pkgs_per_request:]
+        if len(packages) == 0:
+            return
 
-            url = f"https://aur.archlinux.org/rpc/v5/info?{'&'.join(to_request)}"
-            l.print_debug(f"Request URL = {url}")
+        max_pkgs_per_request = 200
+        batches = [
+            packages[i:i + max_pkgs_per_request]
+            for i in range(0, len(packages), max_pkgs_per_request)
+        ]
 
-            try:
-                request = requests.get(url, timeout=conf.aur_rpc_timeout)
-                d = request.json()
+        if len(batches) == 1:
+            batch_results = [self._fetch_aur_info(batches[0])]
+        else:
+            # Requests are independent, so overlap their round trips. Results are still
+            # processed here, because creating PackageInfos queries pacman.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(
+                    len(batches), _MAX_PARALLEL_AUR_REQUESTS)) as executor:
+                batch_results = list(
+                    executor.map(self._fetch_aur_info, batches))
+
+        fetched_results = [
+            result for results in batch_results for result in results
+        ]
+        now = time.time()
+        for result in fetched_results:
+            self._aur_result_cache[result["Name"]] = (now, result)
+            self._aur_result_cache_changed = True
+        self._cache_aur_results(fetched_results)
+
+    def _fetch_aur_info(self, to_request: list[str]) -> list[dict]:
+        params = [("arg[]", p) for p in to_request]
+        l.print_debug(f"Requesting info for {to_request} from AUR.")
 
-                if d["type"] == "error":
-                    raise err.UserFacingError(
-                        f"AUR RPC returned error: {d['error']}")
-
-                for result in d["results"]:
-                    pkgname = result["Name"]
-
-                    if pkgname in self._package_info_cache:
-                        continue
-
-                    for user_package in self._user_packages:
-                        if user_package.pkgname == pkgname:
-                            l.print_debug(
-                                f"'{pkgname}' found in user packages.")
-                            self._package_info_cache[pkgname] = user_package
-                            break
-                    else:  # if not in user_packages then:
-                        info = PackageInfo(
-                            pkgname=result["Name"],
-                            pkgbase=result["PackageBase"],
-                            version=result["Version"],
-                            dependencies=result.get("Depends", []),
-                            make_dependencies=result.get("MakeDepends", []),
-                            check_dependencies=result.get("CheckDepends", []),
-                            provides=result.get("Provides", []),
-                            git_url=
-                            f"https://aur.archlinux.org/{result['PackageBase']}.git",
-                            pacman=self._pacman)
-                        self._package_info_cache[pkgname] = info
-
-                l.print_debug("Request completed.")
-            except (requests.RequestException, KeyError) as e:
-                l.print_error(f"{e}")
+        try:
+            d = self._aur_rpc_get(_AUR_RPC_INFO_URL, params=params)
+
+            if d["type"] == "error":
                 raise err.UserFacingError(
-                    f"Failed to fetch package information for {packages} from AUR RPC."
-                ) from e
+                    f"AUR RPC returned error: {d['error']}")
+
+            l.print_debug("Request completed.")
+            return d["results"]
+        except (_AurRpcError, KeyError, ValueError) as e:
+            l.print_error(f"{e}")
+            raise err.UserFacingError(
+                f"Failed to fetch package information for {to_request} from AUR RPC."
+            ) from e
+
+    def _get_fresh_aur_result(self, package: str) -> typing.Optional[dict]:
+        entry = self._aur_result_cache.get(package)
+        if entry is None or conf.aur_rpc_cache_ttl is None:
+            return None
+
+        timestamp, result = entry
+        if time.time() - timestamp > conf.aur_rpc_cache_ttl:
+            return None
+        return result
+
+    def _load_aur_result_cache(self):
+        assert self._cache_file is not None
+
+        if conf.aur_rpc_cache_ttl is None or not os.path.exists(
+                self._cache_file):
+            return
+
+        l.print_debug(f"Reading AUR RPC cache from '{self._cache_file}'.")
+
+        try:
+            with open(self._cache_file, "rt", encoding="utf-8") as file:
+                d = json.load(file)
+            if not isinstance(d, dict):
+                raise ValueError("the cache is not a JSON object")
+
+            # Entries are only used once the whole file has been read successfully.
+            loaded = {}
+            now = time.time()
+            for pkgname, (timestamp, result) in d.items():
+                if not isinstance(result, dict):
+                    raise ValueError(f"invalid entry for '{pkgname}'")
+                if now - timestamp <= conf.aur_rpc_cache_ttl:
+                    loaded[pkgname] = (timestamp, result)
+            self._aur_result_cache.update(loaded)
+        except (OSError, ValueError, TypeError) as e:
+            # The cache is only an optimization, so it's fine to start from scratch.
+            l.print_debug(f"Ignoring unreadable AUR RPC cache: {e}")
+
+    def save_cache(self):
+        """
+        Writes AUR RPC results to the cache file if new results were fetched since the last save.
+        """
+        if (self._cache_file is None or conf.aur_rpc_cache_ttl is None
+                or not self._aur_result_cache_changed):
+            return
+
+        l.print_debug(f"Writing AUR RPC cache to '{self._cache_file}'.")
+
+        tmp_file = f"{self._cache_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self._cache_file), exist_ok=True)
+            with open(tmp_file, "wt", encoding="utf-8") as file:
+                json.dump(self._aur_result_cache, file)
+            os.replace(tmp_file, self._cache_file)
+            self._aur_result_cache_changed = False
+        except OSError as e:
+            l.print_warning(
+                f"Failed to write AUR RPC cache '{self._cache_file}': {e}")
+
+    def _aur_rpc_get(
+            self,
+            url: str,
+            params: typing.Optional[list[tuple[str, str]]] = None) -> dict:
+        import requests
+
+        try:
+            response = self._get_session().get(url,
+                                               params=params,
+                                               timeout=conf.aur_rpc_timeout)
+            # orjson is optional but decodes large responses much faster
+            if orjson is not None:
+                return orjson.loads(response.content)
+            return response.json()
+        except requests.RequestException as e:
+            raise _AurRpcError(e) from e
+
+    def _get_session(self) -> "requests.Session":
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                import requests.adapters
+                import urllib3.util
+
+                # Reuse one connection to the AUR for all RPC requests
+                self._session = requests.Session()
+                self._session.mount(
+                    "https://",
+                    requests.adapters.HTTPAdapter(
+                        max_retries=urllib3.util.Retry(
+                            total=3,
+                            backoff_factor=0.2,
+                            status_forcelist=(502, 503, 504),
+                        )))
+            return self._session
+
+    def _cache_aur_results(self, results: list[dict]):
+        # Creating PackageInfos checks every dependency with pacman, so check all of them at once.
+        deps = set()
+        for result in results:
+            deps.update(result.get("Depends", []))
+            deps.update(result.get("MakeDepends", []))
+            deps.update(result.get("CheckDepends", []))
+        self._pacman.prefetch_installable(deps)
+
+        for result in results:
+            self._cache_aur_result(result)
+
+    def _cache_aur_result(self, result: dict):
+        pkgname = result["Name"]
+
+        if pkgname in self._package_info_cache:
+            return
+
+        user_package = self._user_packages.get(pkgname)
+        if user_package is not None:
+            l.print_debug(f"'{pkgname}' found in user packages.")
+            self._package_info_cache[pkgname] = user_package
+            return
+
+        self._package_info_cache[pkgname] = PackageInfo(
+            pkgname=result["Name"],
+            pkgbase=result["PackageBase"],
+            version=result["Version"],
+            dependencies=result.get("Depends", []),
+            make_dependencies=result.get("MakeDepends", []),
+            check_dependencies=result.get("CheckDepends", []),
+            provides=result.get("Provides", []),
+            git_url=f"https://aur.archlinux.org/{result['PackageBase']}.git",
+            pacman=self._pacman)
 
     def get_package_info(self, package: str) -> typing.Optional[PackageInfo]:
         """
@@ -342,49 +581,20 @@ class ExtendedPackageSearch:
             l.print_debug(f"'{package}' found in cache.")
             return self._package_info_cache[package]
 
-        for user_package in self._user_packages:
-            if user_package.pkgname == package:
-                l.print_debug(f"'{package}' found in user packages.")
-                self._package_info_cache[package] = user_package
-                return user_package
+        user_package = self._user_packages.get(package)
+        if user_package is not None:
+            l.print_debug(f"'{package}' found in user packages.")
+            self._package_info_cache[package] = user_package
+            return user_package
 
-        url = f"https://aur.archlinux.org/rpc/v5/info/{package}"
-        l.print_debug(f"Requesting info for '{package}' from AUR. URL = {url}")
-        try:
-            request = requests.get(url, timeout=conf.aur_rpc_timeout)
-            d = request.json()
-
-            if d["type"] == "error":
-                raise err.UserFacingError(
-                    f"AUR RPC returned error: {d['error']}")
-
-            if d["resultcount"] == 0:
-                l.print_debug(f"'{package}' not found.")
-                return None
+        self.try_caching_packages([package])
 
+        info = self._package_info_cache.get(package)
+        if info is None:
+            l.print_debug(f"'{package}' not found.")
+        else:
             l.print_debug(f"'{package}' found from AUR.")
-
-            result = d["results"][0]
-            info = PackageInfo(
-                pkgname=result["Name"],
-                pkgbase=result["PackageBase"],
-                version=result["Version"],
-                dependencies=result.get("Depends", []),
-                make_dependencies=result.get("MakeDepends", []),
-                check_dependencies=result.get("CheckDepends", []),
-                provides=result.get("Provides", []),
-                git_url=
-                f"https://aur.archlinux.org/{result['PackageBase']}.git",
-                pacman=self._pacman)
-
-            self._package_info_cache[package] = info
-
-            return info
-        except (requests.RequestException, KeyError) as e:
-            l.print_error(f"{e}")
-            raise err.UserFacingError(
-                f"Failed to fetch package information for {package} from AUR RPC."
-            ) from e
+        return info
 
     def find_provider(
             self, stripped_dependency: str) -> typing.Optional[PackageInfo]:
@@ -395,9 +605,10 @@ class ExtendedPackageSearch:
         """
         l.print_debug(f"Finding provider for '{stripped_dependency}'.")
 
-        if stripped_dependency in self._dep_provider_cache:
+        cached = self._dep_provider_cache.get(stripped_dependency)
+        if cached is not None:
             l.print_debug(f"'{stripped_dependency}' found in cache.")
-            return self._dep_provider_cache[stripped_dependency]
+            return cached
 
         l.print_debug("Are there exact name matches?")
 
@@ -410,10 +621,8 @@ class ExtendedPackageSearch:
 
         l.print_debug("No exact name matches found. Finding providers.")
 
-        user_pkg_results = []
-        for user_package in self._user_packages:
-            if stripped_dependency in user_package.provides:
-                user_pkg_results.append(user_package.pkgname)
+        user_pkg_results = list(
+            self._user_pkg_providers.get(stripped_dependency, {}))
 
         if len(user_pkg_results) == 1:
             pkg = self.get_package_info(user_pkg_results[0])
@@ -433,8 +642,7 @@ class ExtendedPackageSearch:
             f"Requesting providers for '{stripped_dependency}' from AUR. URL = {url}"
         )
         try:
-            request = requests.get(url, timeout=conf.aur_rpc_timeout)
-            d = request.json()
+            d = self._aur_rpc_get(url)
 
             if d["type"] == "error":
                 raise err.UserFacingError(
@@ -452,10 +660,12 @@ class ExtendedPackageSearch:
                     f"Single provider for '{stripped_dependency}' found from AUR: '{pkgname}'"
                 )
                 info = self.get_package_info(pkgname)
+                if info is not None:
+                    self._dep_provider_cache[stripped_dependency] = info
                 return info
 
             return self._choose_provider(stripped_dependency, results, "AUR")
-        except (requests.RequestException, KeyError) as e:
+        except (_AurRpcError, KeyError, ValueError) as e:
             l.print_error(f"{e}")
             raise err.UserFacingError(
                 f"Failed to search for {stripped_dependency} from AUR RPC."
@@ -533,7 +743,7 @@ class ResolvedDependencies:
         """
         Returns some package name that the given pkgbase has.
         """
-        return list(self._pkgbases_to_pkgs[pkgbase])[0]
+        return next(iter(self._pkgbases_to_pkgs[pkgbase]))
 
 
 class ForeignPackageManager:
@@ -564,8 +774,7 @@ class ForeignPackageManager:
         l.print_debug(
             f"Foreign packages to check for upgrades: {all_foreign_pkgs}")
 
-        self._search.try_caching_packages(
-            list(map(lambda p: p[0], all_foreign_pkgs)))
+        self._search.try_caching_packages(pkg for pkg, _ in all_foreign_pkgs)
 
         as_explicit = []
         as_deps = []
@@ -586,6 +795,8 @@ class ForeignPackageManager:
                 else:
                     as_deps.append(pkg)
 
+        self._search.save_cache()
+
         l.print_debug(
             f"The following foreign packages will be upgraded: {' '.join(as_explicit)}"
         )
@@ -611,17 +822,17 @@ class ForeignPackageManager:
 
         l.print_list(
             "The following foreign packages will be installed explicitly:",
-            list(resolved_dependencies.foreign_pkgs),
+            sorted(resolved_dependencies.foreign_pkgs),
             level=l.SUMMARY)
 
         l.print_list(
             "The following foreign packages will be installed as dependencies:",
-            list(resolved_dependencies.foreign_dep_pkgs),
+            sorted(resolved_dependencies.foreign_dep_pkgs),
             level=l.SUMMARY)
 
         l.print_list(
             "The following foreign packages will be built in order to install other packages. They will not be installed:",
-            list(resolved_dependencies.foreign_build_dep_pkgs),
+            sorted(resolved_dependencies.foreign_build_dep_pkgs),
             level=l.SUMMARY)
 
         if not l.prompt_confirm("Proceed?", default=True):
@@ -629,13 +840,12 @@ class ForeignPackageManager:
 
         l.print_summary("Installing foreign package dependencies from pacman.")
         self._pacman.install_dependencies(
-            list(resolved_dependencies.pacman_deps))
+            sorted(resolved_dependencies.pacman_deps))
 
         try:
             with PackageBuilder(self._search, self._store,
                                 resolved_dependencies) as builder:
-                while resolved_dependencies.build_order:
-                    to_build = resolved_dependencies.build_order.pop(0)
+                for to_build in resolved_dependencies.build_order:
 
                     pkgbase = resolved_dependencies.get_pkgbase(to_build)
                     package_names = resolved_dependencies.get_pkgs_with_common_pkgbase(
@@ -664,7 +874,7 @@ class ForeignPackageManager:
         if package_files_to_install or force:
             l.print_summary("Installing foreign packages.")
             self._pacman.install_files(package_files_to_install,
-                                       as_explicit=list(
+                                       as_explicit=sorted(
                                            resolved_dependencies.foreign_pkgs))
         else:
             l.print_summary("No packages to install.")
@@ -717,30 +927,42 @@ class ForeignPackageManager:
                 seen_packages.add(dep_info.pkgname)
 
         while to_process:
-            pkgname = to_process.pop()
-
-            info = self._search.get_package_info(pkgname)
-            if info is None:
-                raise err.UserFacingError(
-                    f"Failed to find '{pkgname}' from AUR or user provided packages."
-                )
-
-            result.pacman_deps.update(info.pacman_dependencies)
-            result.add_pkgbase_info(pkgname, info.pkgbase)
+            # Packages are resolved one level at a time, so that the dependencies of the whole
+            # level can be cached with as few AUR requests as possible.
+            level, to_process = to_process, []
+
+            level_infos = []
+            for pkgname in level:
+                info = self._search.get_package_info(pkgname)
+                if info is None:
+                    raise err.UserFacingError(
+                        f"Failed to find '{pkgname}' from AUR or user provided packages."
+                    )
 
-            build_deps = info.foreign_make_dependencies_stripped + info.foreign_check_dependencies_stripped
+                result.pacman_deps.update(info.pacman_dependencies)
+                result.add_pkgbase_info(pkgname, info.pkgbase)
+                level_infos.append((pkgname, info))
 
             self._search.try_caching_packages(
-                info.foreign_dependencies_stripped + build_deps)
+                dep for _, info in level_infos
+                for dep in (info.foreign_dependencies_stripped +
+                            info.foreign_make_dependencies_stripped +
+                            info.foreign_check_dependencies_stripped))
+
+            for pkgname, info in level_infos:
+                for depname in info.foreign_dependencies_stripped:
+                    process_dep(pkgname, depname, result.foreign_dep_pkgs)
 
-            for depname in info.foreign_dependencies_stripped:
-                process_dep(pkgname, depname, result.foreign_dep_pkgs)
+                for depname in (info.foreign_make_dependencies_stripped +
+                                info.foreign_check_dependencies_stripped):
+                    process_dep(pkgname, depname,
+                                result.foreign_build_dep_pkgs)
 
-            for depname in build_deps:
-                process_dep(pkgname, depname, result.foreign_build_dep_pkgs)
+                total_processed += 1
+                l.print_info(
+                    f"Progress: {total_processed}/{len(seen_packages)}.")
 
-            total_processed += 1
-            l.print_info(f"Progress: {total_processed}/{len(seen_packages)}.")
+        self._search.save_cache()
 
         l.print_info("Determining build order.")
 
@@ -751,7 +973,7 @@ class ForeignPackageManager:
                 break
 
             for pkg in to_add:
-                if pkg not in result.packages:
+                if pkg.name not in result.packages:
                     l.print_debug(f"Adding {pkg} to build_order.")
                     result.build_order.append(pkg.name)
                     result.packages[pkg.name] = pkg
@@ -773,11 +995,7 @@ class ForeignPackageManager:
             return True
 
         try:
-            result = int(
-                subprocess.run(conf.commands.compare_versions(
-                    installed_version, fetched_version),
-                               check=True,
-                               stdout=subprocess.PIPE).stdout.decode())
+            result = _compare_versions(installed_version, fetched_version)
             should_upgrade = result < 0
             l.print_debug(
                 f"Installed version is: {installed_version}. Available version is {fetched_version}. Should upgrade: {should_upgrade}"
@@ -875,7 +1093,7 @@ class PackageBuilder:
             pass
 
         subprocess.run(conf.commands.make_chroot(self.chroot_dir,
-                                                 list(self._pkgs_in_chroot)),
+                                                 sorted(self._pkgs_in_chroot)),
                        env=mkarchroot_env_vars,
                        check=True,
                        capture_output=conf.suppress_command_output)
@@ -935,7 +1153,9 @@ class PackageBuilder:
         for pkgname in package_names:
             file = self._find_pkgfile(pkgname, pkgbuild_dir)
 
-            dest = shutil.copy(file, conf.pkg_cache_dir)
+            # Only the data is needed, pacman doesn't care about the mode of the cached file.
+            dest = shutil.copyfile(
+                file, os.path.join(conf.pkg_cache_dir, os.path.basename(file)))
 
             pkg_info = self._search.get_package_info(pkgname)
 
@@ -993,19 +1213,14 @@ class PackageBuilder:
         chroot_pacman_build_deps = set()
         chroot_foreign_pkgs = set()
 
-        def add_to_pacman_build_deps(deps: list[str]):
-            for dep in deps:
-                if dep not in self._resolved_deps.pacman_deps:
-                    chroot_pacman_build_deps.add(dep)
-
         for pkg in pkgs_to_build:
             info = self._search.get_package_info(pkg.name)
             # Because all dependencies and packages should be resolved during the creation
             # of ResolvedDependencies. git_url should not be None.
             assert info is not None
 
-            add_to_pacman_build_deps(info.pacman_make_dependencies)
-            add_to_pacman_build_deps(info.pacman_check_dependencies)
+            chroot_pacman_build_deps.update(info.pacman_make_dependencies)
+            chroot_pacman_build_deps.update(info.pacman_check_dependencies)
 
             foreign_deps = pkg.get_all_recursive_foreign_dep_pkgs()
             chroot_foreign_pkgs.update(foreign_deps)
@@ -1017,14 +1232,18 @@ class PackageBuilder:
                 # of ResolvedDependencies. git_url should not be None.
                 assert dep_info is not None
 
-                add_to_pacman_build_deps(dep_info.pacman_make_dependencies)
-                add_to_pacman_build_deps(dep_info.pacman_check_dependencies)
+                chroot_pacman_build_deps.update(
+                    dep_info.pacman_make_dependencies)
+                chroot_pacman_build_deps.update(
+                    dep_info.pacman_check_dependencies)
+
+        # Pacman dependencies of the resolved packages are already in the chroot
+        chroot_pacman_build_deps -= self._resolved_deps.pacman_deps
 
         # Packages with the same pkgbase might depend on each other,
         # but they don't need to be installed for the build to succeed.
-        for pkg in pkgs_to_build:
-            if pkg.name in chroot_foreign_pkgs:
-                chroot_foreign_pkgs.remove(pkg.name)
+        chroot_foreign_pkgs.difference_update(pkg.name
+                                              for pkg in pkgs_to_build)
 
         chroot_foreign_pkg_files = []
 
@@ -1037,7 +1256,7 @@ before and thus are found in the cache."
 
             chroot_foreign_pkg_files.append(file)
 
-        return (list(chroot_pacman_build_deps), chroot_foreign_pkg_files)
+        return (sorted(chroot_pacman_build_deps), chroot_foreign_pkg_files)
 
     def _find_pkgfile(self, pkgname: str, pkgbuild_dir: str) -> str:
         # HACK: Because we don't know the pkgarch we can't be sure what is the build result.
@@ -1049,12 +1268,11 @@ before and thus are found in the cache."
         assert info is not None
         prefix = info.pkg_file_prefix()
 
+        valid_pkgexts = tuple(conf.valid_pkgexts)
         for file in os.scandir(pkgbuild_dir):
             if file.is_file() and file.name.startswith(prefix):
-                for ext in conf.valid_pkgexts:
-                    if file.name.endswith(ext):
-                        matches.append(file.path)
-                        continue
+                if file.name.endswith(valid_pkgexts):
+                    matches.append(file.path)
 
         if len(matches) != 1:
             raise err.UserFacingError(
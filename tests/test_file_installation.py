@@ -0,0 +1,42 @@
+# pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring,protected-access
+
+import io
+import unittest
+from unittest import mock
+import decman
+
+
+class TestVariableSubstitution(unittest.TestCase):
+
+    def setUp(self):
+        self.variables = {
+            "%user%": "kk",
+            "%home%": "/home/kk",
+            "%x%": "longer value",
+        }
+
+    def replace_whole_file(self, content: str) -> str:
+        for var, value in self.variables.items():
+            content = content.replace(var, value)
+        return content
+
+    def stream(self, content: str, chunk_size: int) -> str:
+        dst = io.StringIO()
+        with mock.patch("decman._TEMPLATE_CHUNK_SIZE", chunk_size):
+            decman._stream_substituted(io.StringIO(content), dst,
+                                       self.variables)
+        return dst.getvalue()
+
+    def test_variables_split_between_chunks(self):
+        content = "user=%user%\nhome=%home%/.config %x%%x% 100%\n%user%"
+        for chunk_size in range(1, 10):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.stream(content, chunk_size),
+                                 self.replace_whole_file(content))
+
+    def test_trailing_unmatched_percent(self):
+        content = "%user% uses 50% of %hom"
+        for chunk_size in range(1, 10):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.stream(content, chunk_size),
+                                 self.replace_whole_file(content))
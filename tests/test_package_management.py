@@ -1,17 +1,25 @@
-# pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
+# pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring,protected-access
 
+import json
+import os
+import tempfile
+import time
 import unittest
+from decman import UserPackage
+import decman.config as conf
 from decman.error import UserFacingError
 from decman.lib import Pacman, Store
-from decman.lib.fpm import ForeignPackageManager, DepGraph, ForeignPackage, ExtendedPackageSearch
+from decman.lib.fpm import ForeignPackageManager, DepGraph, ForeignPackage, ExtendedPackageSearch, PackageInfo
 
 
 class TestVersionComparisons(unittest.TestCase):
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        # should_upgrade_package doesn't modify any state, so the instances can be shared
         pacman = Pacman()
-        self.pm = ForeignPackageManager(Store(), pacman,
-                                        ExtendedPackageSearch(pacman))
+        cls.pm = ForeignPackageManager(Store(), pacman,
+                                       ExtendedPackageSearch(pacman))
 
     def test_should_upgrade_package_returns_true_on_newer_version(self):
         self.assertTrue(
@@ -57,6 +65,19 @@ class TestDepGraph(unittest.TestCase):
         with self.assertRaises(UserFacingError):
             graph.add_requirement("A", "C")
 
+    def test_cyclic_dep_through_shared_parents_fails(self):
+        graph = DepGraph()
+
+        graph.add_requirement("A", None)
+        graph.add_requirement("B1", "A")
+        graph.add_requirement("B2", "A")
+        graph.add_requirement("C", "B1")
+        graph.add_requirement("C", "B2")
+        graph.add_requirement("D", "C")
+
+        with self.assertRaises(UserFacingError):
+            graph.add_requirement("A", "D")
+
     def test_get_and_remove_outer_deps(self):
         graph = DepGraph()
 
@@ -104,3 +125,151 @@ class TestDepGraph(unittest.TestCase):
         self.assertCountEqual(graph.get_and_remove_outer_dep_pkgs(), [b2])
         self.assertCountEqual(graph.get_and_remove_outer_dep_pkgs(), [a])
         self.assertCountEqual(graph.get_and_remove_outer_dep_pkgs(), [])
+
+
+class OfflinePacman(Pacman):
+
+    def is_installable(self, dependency: str) -> bool:
+        return False
+
+    def prefetch_installable(self, dependencies):
+        pass
+
+
+class TestDependencyResolution(unittest.TestCase):
+
+    def setUp(self):
+        self.pacman = OfflinePacman()
+        self.search = ExtendedPackageSearch(self.pacman)
+        # Only user packages are used, so the AUR never has results.
+        self.search._aur_rpc_get = lambda url, params=None: {
+            "type": "search",
+            "resultcount": 0,
+            "results": [],
+        }
+        self.pm = ForeignPackageManager(Store(), self.pacman, self.search)
+
+    def add_user_pkg(self, pkgname: str, dependencies: list[str], **kwargs):
+        self.search.add_user_pkg(
+            PackageInfo.from_user_package(
+                UserPackage(pkgname=pkgname,
+                            version="1",
+                            dependencies=dependencies,
+                            git_url="/am/url/yes",
+                            **kwargs), self.pacman))
+
+    def test_dependency_resolved_through_versioned_provide(self):
+        self.add_user_pkg("A", ["libfoo>=1.0"])
+        self.add_user_pkg("foo-impl", [], provides=["libfoo=1.2"])
+
+        resolved = self.pm.resolve_dependencies(["A"])
+
+        self.assertEqual(resolved.foreign_dep_pkgs, {"foo-impl"})
+        self.assertEqual(resolved.build_order, ["foo-impl", "A"])
+
+    def test_provide_with_and_without_version_is_a_single_provider(self):
+        self.add_user_pkg("A", ["foo"])
+        self.add_user_pkg("foo-git", [], provides=["foo", "foo=1.2"])
+
+        provider = self.search.find_provider("foo")
+
+        self.assertIsNotNone(provider)
+        self.assertEqual(provider.pkgname, "foo-git")
+
+    def test_shared_dependency_built_once(self):
+        self.add_user_pkg("A", ["C"])
+        self.add_user_pkg("B", ["C"])
+        self.add_user_pkg("C", [])
+
+        resolved = self.pm.resolve_dependencies(["A", "B"])
+
+        self.assertEqual(resolved.build_order.count("C"), 1)
+        self.assertEqual(resolved.build_order[0], "C")
+        self.assertCountEqual(resolved.build_order, ["A", "B", "C"])
+        self.assertEqual(resolved.packages["C"].name, "C")
+
+
+def aur_result(pkgname: str, version: str = "1") -> dict:
+    return {"Name": pkgname, "PackageBase": pkgname, "Version": version}
+
+
+class TestAurRpcCache(unittest.TestCase):
+
+    def setUp(self):
+        self._original_ttl = conf.aur_rpc_cache_ttl
+        conf.aur_rpc_cache_ttl = 600
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self._tmp_dir.name, "cache.json")
+        self.requested = []
+
+    def tearDown(self):
+        conf.aur_rpc_cache_ttl = self._original_ttl
+        self._tmp_dir.cleanup()
+
+    def write_cache(self, content: str):
+        with open(self.cache_file, "wt", encoding="utf-8") as file:
+            file.write(content)
+
+    def new_search(self) -> ExtendedPackageSearch:
+        search = ExtendedPackageSearch(OfflinePacman(),
+                                       cache_file=self.cache_file)
+
+        def aur_rpc_get(url, params=None):
+            names = [name for _, name in params or []]
+            self.requested.extend(names)
+            return {
+                "type": "multiinfo",
+                "results": [aur_result(name) for name in names]
+            }
+
+        search._aur_rpc_get = aur_rpc_get
+        return search
+
+    def test_fresh_results_are_used_and_expired_fetched(self):
+        now = time.time()
+        self.write_cache(
+            json.dumps({
+                "fresh": [now - 10, aur_result("fresh", "2")],
+                "expired": [now - 700, aur_result("expired", "2")],
+            }))
+        search = self.new_search()
+
+        search.try_caching_packages(["fresh", "expired"])
+
+        self.assertEqual(self.requested, ["expired"])
+        self.assertEqual(search.get_package_info("fresh").version, "2")
+        self.assertEqual(search.get_package_info("expired").version, "1")
+
+    def test_unreadable_cache_is_ignored(self):
+        for content in ("not json", "[]", "null", '{"a": [0, []]}',
+                        '{"a": 1}'):
+            with self.subTest(content=content):
+                self.requested = []
+                self.write_cache(content)
+                search = self.new_search()
+
+                search.try_caching_packages(["a"])
+
+                self.assertEqual(self.requested, ["a"])
+
+    def test_cache_saved_only_when_results_were_fetched(self):
+        search = self.new_search()
+        search.save_cache()
+        self.assertFalse(os.path.exists(self.cache_file))
+
+        search.try_caching_packages(["a"])
+        search.save_cache()
+        with open(self.cache_file, "rt", encoding="utf-8") as file:
+            self.assertEqual(list(json.load(file)), ["a"])
+
+        self.requested = []
+        reloaded_search = self.new_search()
+        reloaded_search.try_caching_packages(["a"])
+        reloaded_search.save_cache()
+        self.assertEqual(self.requested, [])
+
+        # Nothing new was fetched, so neither search writes the file again.
+        os.remove(self.cache_file)
+        search.save_cache()
+        reloaded_search.save_cache()
+        self.assertFalse(os.path.exists(self.cache_file))
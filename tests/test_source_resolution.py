@@ -105,6 +105,16 @@ class DisabledTestModule(Module):
         return ["M_1.service"]
 
 
+class SharedUserUnitsTestModule(Module):
+
+    def __init__(self, name: str, units: list[str]):
+        self.units = units
+        super().__init__(name, True, "1")
+
+    def systemd_user_units(self) -> dict[str, list[str]]:
+        return {"user": self.units}
+
+
 class TestSource(unittest.TestCase):
 
     def setUp(self):
@@ -239,6 +249,28 @@ class TestSource(unittest.TestCase):
             },
         )
 
+    def test_user_units_of_the_same_user_are_merged(self):
+        source = Source(
+            pacman_packages=set(),
+            aur_packages=set(),
+            user_packages=set(),
+            ignored_packages=set(),
+            systemd_units=set(),
+            systemd_user_units={"user": {"u1.service"}},
+            modules={
+                SharedUserUnitsTestModule("Shared1", ["M_u1.service"]),
+                SharedUserUnitsTestModule("Shared2",
+                                          ["M_u2.service", "u1.service"]),
+            },
+            files={},
+            directories={},
+        )
+
+        self.assertDictEqual(
+            source.user_units_to_enable(Store()),
+            {"user": ["M_u1.service", "M_u2.service", "u1.service"]},
+        )
+
     def test_user_units_to_disable(self):
         self.assertDictEqual(
             self.source.user_units_to_disable(self.store),